@@ -1,12 +1,18 @@
 import abc
+import json
 import pkgutil
-from typing import Dict
+import sys
+from collections import namedtuple
+from typing import Dict, Tuple
 
 import numpy as np
 
 from parameters import Parameters
+from structures.ensemble import Ensemble
 from structures.molecule import Molecule
 
+CalculationFailure = namedtuple('CalculationFailure', 'reason detail')
+
 
 class ChargeMethodSkeleton(abc.ABC):
     NAME = '<name>'
@@ -19,11 +25,21 @@ class ChargeMethodSkeleton(abc.ABC):
 
     def __init__(self):
         self._parameters = Parameters(self.COMMON_PARAMETERS, self.ATOM_PARAMETERS)
+        self._failures: Dict[str, CalculationFailure] = {}
 
     @property
     def parameters(self):
         return self._parameters
 
+    @property
+    def failures(self) -> Dict[str, CalculationFailure]:
+        """Molecules for which the last calculation of charges failed"""
+        return self._failures
+
+    def report_failure(self, molecule: Molecule, reason: str, detail=None) -> np.ndarray:
+        self._failures[molecule.name] = CalculationFailure(reason, detail)
+        return np.full(len(molecule), np.nan, dtype=np.float_)
+
     @abc.abstractmethod
     def initialize(self, options: Dict):
         pass
@@ -32,6 +48,33 @@ class ChargeMethodSkeleton(abc.ABC):
     def calculate_charges(self, molecule: Molecule) -> np.ndarray:
         pass
 
+    def calculate_ensemble_charges(self, ensemble: Ensemble) -> np.ndarray:
+        """Charges of all conformers of the ensemble, one row per conformer"""
+        charges = np.empty((len(ensemble), len(ensemble.molecule)), dtype=np.float_)
+        for k, conformer in enumerate(ensemble.conformers):
+            charges[k] = self.calculate_charges(conformer)
+            self.release(conformer)
+
+        return charges
+
+    def estimate_cost(self, molecule: Molecule) -> Tuple[float, int]:
+        """Relative time and memory in bytes needed to calculate charges of the molecule"""
+        return len(molecule), len(molecule) * np.dtype(molecule.dtype).itemsize
+
+    def release(self, molecule: Molecule):
+        """Free anything kept for later calculations of the molecule"""
+        pass
+
 
 def get_charge_methods():
     return list(m.name for m in pkgutil.iter_modules(['methods']))
+
+
+def save_failures(failures: Dict[str, CalculationFailure], filename: str):
+    data = {name: failure._asdict() for name, failure in failures.items()}
+    try:
+        with open(filename, 'w') as f:
+            json.dump(data, f, indent=2)
+    except IOError:
+        print('Cannot store failures to file: {}'.format(filename), file=sys.stderr)
+        sys.exit(1)
@@ -1,6 +1,6 @@
 import json
 import sys
-from typing import Dict
+from typing import Dict, Iterable
 
 import numpy as np
 
@@ -38,6 +38,17 @@ class Charges:
 
         return Charges(data)
 
+    @classmethod
+    def merge(cls, charges_list: Iterable['Charges']):
+        merged = Charges()
+        for charges in charges_list:
+            for name in charges:
+                if name in merged._data:
+                    raise RuntimeError('Two molecules with the same name! ({})'.format(name))
+                merged[name] = charges[name]
+
+        return merged
+
     def save_to_file(self, filename: str):
         data_copy = {}
         for key, value in self._data.items():
@@ -1,5 +1,5 @@
 import abc
-from typing import Dict, Tuple
+from typing import Dict, Tuple, Callable, Any, List
 
 from parameters import ParameterError, AtomParameters
 from structures.atom import Atom
@@ -48,8 +48,24 @@ class ParametersClassifier(Classifier):
         self._parameters = parameters
 
     def get_type(self, molecule: Molecule, atom: Atom):
+        return self.select_type(atom, lambda classifier: classifiers[classifier].get_type(molecule, atom)[1])
+
+    def select_type(self, atom: Atom, base_type: Callable[[str], Any]):
+        """Select the first type having parameters, base_type gives the type assigned to the atom by a classifier"""
         for classifier, atom_type in self._parameters.data[atom.element.symbol]:
-            if classifiers[classifier].get_type(molecule, atom)[1] == atom_type:
+            if base_type(classifier) == atom_type:
                 return classifier, atom_type
 
         raise ParameterError('No parameter found for atom {}'.format(atom.element.symbol))
+
+
+def classify_multiple(molecule: Molecule, atom: Atom, parameters_classifiers: List[ParametersClassifier]) -> List:
+    """Classify the atom for several parameter sets, evaluating each of the classifiers only once"""
+    base_types = {}
+
+    def base_type(classifier: str):
+        if classifier not in base_types:
+            base_types[classifier] = classifiers[classifier].get_type(molecule, atom)[1]
+        return base_types[classifier]
+
+    return [(atom.element.symbol, *pc.select_type(atom, base_type)) for pc in parameters_classifiers]
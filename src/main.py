@@ -1,58 +1,198 @@
 #!/usr/bin/env python3
 
 import importlib
+import os
+import sys
 from pprint import pprint
 
+import numpy as np
+
+from charge_method import ChargeMethodSkeleton, save_failures
 from charges import Charges
 from classifier import classifiers, ParametersClassifier
-from options import parse_arguments
-from parameterization import parameterize
-from statistics import calculate_all_total, calculate_all_per_atom_type
+from options import parse_arguments, precisions
+from parameterization import parameterize, cross_validate
+from pipeline import calculate_pipelined
+from scheduler import calculate_scheduled
+from statistics import StatisticsAccumulator
+from structures.ensemble import iterate_ensembles, boltzmann_weights, average_charges
 from structures.molecule_set import MoleculeSet
+from writers import writers
+
+
+def report_failures(method: ChargeMethodSkeleton, filename: str, label: str = None):
+    prefix = '{}: '.format(label) if label is not None else ''
+    if method.failures:
+        print('{}Charges of {} molecules could not be calculated'.format(prefix, len(method.failures)),
+              file=sys.stderr)
+
+    if filename is not None:
+        save_failures(method.failures, filename)
 
 
 def main():
     global_options, method_options = parse_arguments()
 
     if global_options['command'] == 'info':
-        molecules = MoleculeSet.load_from_file(global_options['sdf_file'])
-        molecules.assign_atom_types(classifiers[global_options['classifier']])
+        molecules = MoleculeSet.load_from_file(global_options['sdf_file'],
+                                               classifier=classifiers[global_options['classifier']],
+                                               processes=global_options['processes'],
+                                               dtype=precisions[global_options['precision']])
         molecules.stats()
 
     elif global_options['command'] == 'charges':
-        molecules = MoleculeSet.load_from_file(global_options['sdf_file'])
-
         m = importlib.import_module('methods.' + global_options['method'])
         method = m.ChargeMethod()
         method.initialize(method_options)
 
-        pc = ParametersClassifier(method.parameters.atom)
-        molecules.assign_atom_types(pc)
-
-        charges: Charges = Charges()
-        for molecule in molecules:
-            charges[molecule.name] = method.calculate_charges(molecule)
-
+        pc = ParametersClassifier(method.parameters.atom) if method.ATOM_PARAMETERS else None
+        writer_type = writers[global_options['format']]
+        if global_options['conformers'] is not None or global_options['pipeline']:
+            conformers = global_options['conformers'] is not None
+            mode = '--conformers' if conformers else '--pipeline'
+            unsupported = [('--pipeline', conformers and global_options['pipeline']),
+                           ('--shard', conformers and global_options['shard'] is not None),
+                           ('--workers', global_options['workers'] != 1),
+                           ('--max-memory', global_options['max_memory'] is not None),
+                           ('--processes', global_options['processes'] != 1)]
+            for option, given in unsupported:
+                if given:
+                    print('{} cannot be used with {}'.format(option, mode), file=sys.stderr)
+                    sys.exit(1)
+
+        if global_options['conformers'] is not None:
+            with writer_type(global_options['charges_outfile']) as writer:
+                ensembles = iterate_ensembles(global_options['sdf_file'], pc, precisions[global_options['precision']])
+                for ensemble in ensembles:
+                    charges = method.calculate_ensemble_charges(ensemble)
+                    if global_options['conformers'] == 'all':
+                        for conformer, mol_record, conformer_charges in zip(ensemble.conformers, ensemble.records,
+                                                                            charges):
+                            writer.write(conformer, mol_record, conformer_charges)
+                    else:
+                        weights = None
+                        if global_options['conformers'] == 'boltzmann':
+                            weights = boltzmann_weights(ensemble.energies(global_options['energy_field']),
+                                                        global_options['temperature'])
+                        writer.write(ensemble.molecule, ensemble.records[0], average_charges(charges, weights))
+        elif global_options['pipeline']:
+            with writer_type(global_options['charges_outfile']) as writer:
+                for mol_record, molecule, charges in calculate_pipelined(global_options['sdf_file'], method,
+                                                                         global_options['shard'], pc,
+                                                                         precisions[global_options['precision']],
+                                                                         writer_type.NEEDS_RECORDS):
+                    writer.write(molecule, mol_record, charges)
+        else:
+            loaded = MoleculeSet.iterate_file(global_options['sdf_file'], global_options['shard'], pc,
+                                              global_options['processes'], precisions[global_options['precision']],
+                                              writer_type.NEEDS_RECORDS)
+
+            with writer_type(global_options['charges_outfile']) as writer:
+                if global_options['workers'] > 1 or global_options['max_memory'] is not None:
+                    loaded = list(loaded)
+                    molecules = MoleculeSet(molecule for _, molecule in loaded)
+                    max_memory = global_options['max_memory'] * 2 ** 20 if global_options['max_memory'] else None
+                    scheduled = calculate_scheduled(molecules, method, global_options['workers'], max_memory)
+                    for (mol_record, _), (molecule, charges) in zip(loaded, scheduled):
+                        writer.write(molecule, mol_record, charges)
+                else:
+                    for mol_record, molecule in loaded:
+                        writer.write(molecule, mol_record, method.calculate_charges(molecule))
+                        method.release(molecule)
+
+        report_failures(method, global_options['failures'])
+
+    elif global_options['command'] == 'merge':
+        charges = Charges.merge(Charges.load_from_file(filename) for filename in global_options['charge_files'])
         charges.save_to_file(global_options['charges_outfile'])
 
+    elif global_options['command'] == 'multi':
+        methods = []
+        names = []
+        for name, par_file in global_options['methods']:
+            method = importlib.import_module('methods.' + name).ChargeMethod()
+            options = {option.name: option.default for option in method.OPTIONS}
+            if par_file is not None:
+                options['par_file'] = par_file
+                name += '_' + os.path.splitext(os.path.basename(par_file))[0]
+            method.initialize(options)
+            methods.append(method)
+            names.append(name)
+
+        if len(set(names)) != len(names):
+            print('Each method has to be given with different parameters', file=sys.stderr)
+            sys.exit(1)
+
+        molecules = MoleculeSet.load_from_file(global_options['sdf_file'], global_options['shard'],
+                                               processes=global_options['processes'],
+                                               dtype=precisions[global_options['precision']])
+
+        # Methods without atom parameters do not need atom types
+        typed_methods = [method for method in methods if method.ATOM_PARAMETERS]
+        atom_types = molecules.assign_atom_types_multiple([ParametersClassifier(method.parameters.atom)
+                                                           for method in typed_methods])
+
+        for method, name in zip(methods, names):
+            if method in typed_methods:
+                molecules.set_atom_types(atom_types[typed_methods.index(method)])
+
+            charges: Charges = Charges()
+            for molecule in molecules:
+                charges[molecule.name] = method.calculate_charges(molecule)
+                method.release(molecule)
+
+            charges.save_to_file(os.path.join(global_options['outdir'], name + '.json'))
+            failures_file = None
+            if global_options['failures']:
+                failures_file = os.path.join(global_options['outdir'], name + '_failures.json')
+            report_failures(method, failures_file, name)
+
     elif global_options['command'] == 'parameters':
-        molecules = MoleculeSet.load_from_file(global_options['sdf_file'])
-        molecules.assign_atom_types(classifiers[global_options['classifier']])
+        molecules = MoleculeSet.load_from_file(global_options['sdf_file'],
+                                               classifier=classifiers[global_options['classifier']],
+                                               processes=global_options['processes'],
+                                               dtype=precisions[global_options['precision']])
         m = importlib.import_module('methods.' + global_options['method'])
 
         ref_charges = Charges.load_from_file(global_options['charge_file'])
         method = m.ChargeMethod()
         method.parameters.init_from_set(molecules)
         method.parameters.set_ranges({'kappa': (0.0, 1)}, {'A': (1.6, 3.2), 'B': (0, 1.8)})
-        parameterize(molecules, method, ref_charges)
-
-        new_charges: Charges = Charges()
-        for molecule in molecules:
-            new_charges[molecule.name] = method.calculate_charges(molecule)
-
-        pprint(calculate_all_total(ref_charges, new_charges))
-        pprint(calculate_all_per_atom_type(molecules, ref_charges, new_charges))
 
+        if global_options['folds'] is not None and not 2 <= global_options['folds'] <= len(molecules):
+            print('Number of folds has to be between 2 and the number of molecules', file=sys.stderr)
+            sys.exit(1)
+
+        report = None
+        if global_options['report'] is not None:
+            try:
+                report = open(global_options['report'], 'w', newline='')
+            except IOError:
+                print('Cannot store report to file: {}'.format(global_options['report']), file=sys.stderr)
+                sys.exit(1)
+
+        if global_options['folds'] is not None:
+            # The report and failures are of the test molecules, each with the parameters of its fold
+            fold_statistics, accumulator = cross_validate(molecules, method, ref_charges, global_options['folds'],
+                                                          global_options['workers'], global_options['seed'], report)
+            for k, statistics in enumerate(fold_statistics):
+                print('Fold {}: {}'.format(k + 1, statistics))
+        else:
+            np.random.seed(global_options['seed'])
+            parameterize(molecules, method, ref_charges, global_options['workers'])
+
+            accumulator = StatisticsAccumulator(report)
+            for molecule in molecules:
+                accumulator.add(molecule, ref_charges[molecule.name], method.calculate_charges(molecule))
+                method.release(molecule)
+
+        if report is not None:
+            report.close()
+
+        report_failures(method, global_options['failures'])
+
+        pprint(accumulator.total())
+        pprint(accumulator.per_atom_type())
 
 if __name__ == '__main__':
     main()
@@ -1,9 +1,14 @@
-from typing import Dict
+from typing import Dict, Tuple, Any, List, Callable
 
 import numpy as np
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
+import scipy.spatial
 
-from charge_method import ChargeMethodSkeleton
+from charge_method import ChargeMethodSkeleton, CalculationFailure
 from options import CommandLineOption
+from structures.ensemble import Ensemble
 from structures.molecule import Molecule
 
 
@@ -13,35 +18,257 @@ class ChargeMethod(ChargeMethodSkeleton):
     PUBLICATION = '10.1021/ja00275a013'
 
     OPTIONS = [
-        CommandLineOption(name='par_file', help='File with EEM parameters', type=str, default='../data/eem.json')]
+        CommandLineOption(name='par_file', help='File with EEM parameters', type=str, default='../data/eem.json'),
+        CommandLineOption(name='sparse_limit', help='Molecules with more atoms are solved iteratively without '
+                                                    'storing the whole matrix (none by default)',
+                          type=int, default=None),
+        CommandLineOption(name='cutoff', help='Cutoff (in angstroms) of interactions in the sparse matrix '
+                                              'preconditioning the iterative solution', type=float, default=12.0)]
 
     COMMON_PARAMETERS = ['kappa']
     ATOM_PARAMETERS = ['A', 'B']
 
+    # Systems with the estimated reciprocal condition number below this limit are reported as failures
+    MIN_RCOND = 1e-12
+
+    # Solutions of single precision and sparse systems are refined in double precision at most this many times.
+    # If the residual is not below the tolerance (relative to the right-hand side) by then,
+    # the system is solved in double precision, or reported as a failure if it is sparse.
+    REFINEMENT_STEPS = 2
+    REFINEMENT_TOLERANCE = 1e-10
+
+    # Single precision systems of smaller molecules are not solved faster, refinement costs more than it saves
+    SINGLE_PRECISION_MIN_ATOMS = 500
+
+    # Fill-in of sparse LU factorizations assumed when estimating their memory
+    SPARSE_FILL_IN = 10
+
+    # Truncating 1/r at the cutoff changes charges by tenths of e, shifting or damping it even more,
+    # so the sparse factorization with cutoff only preconditions GMRES on the whole system.
+    # Each solution and refinement step runs at most this many iterations.
+    SPARSE_ITERATIONS = 100
+
+    # Factorizations kept for each molecule. Forward differences of the parameterization perturb
+    # B of one atom type after another, so the one of the base point has to stay besides the latest.
+    FACTORIZATIONS_PER_MOLECULE = 2
+
     def __init__(self):
         super().__init__()
+        # molecule name -> [(kappa, B values, LU factorization or None, CalculationFailure or None)],
+        # the most recently used last
+        self._factorizations: Dict[str, List[Tuple[float, np.ndarray, Any, CalculationFailure]]] = {}
+        self._sparse_limit = self.OPTIONS[1].default
+        self._cutoff = self.OPTIONS[2].default
 
     def initialize(self, options: Dict):
         self.parameters.load_from_file(options['par_file'])
+        self._sparse_limit = options['sparse_limit']
+        self._cutoff = options['cutoff']
 
-    def calculate_charges(self, molecule: Molecule):
-        np.seterr(divide='ignore')
+    def _is_sparse(self, molecule: Molecule) -> bool:
+        return self._sparse_limit is not None and len(molecule) > self._sparse_limit
+
+    def estimate_cost(self, molecule: Molecule) -> Tuple[float, int]:
+        n = len(molecule)
+        if self._is_sparse(molecule):
+            # Assume the density of atoms in organic molecules, about 0.1 per cubic angstrom
+            neighbours = min(n, 4 / 3 * np.pi * self._cutoff ** 3 * 0.1)
+            # The kept factorization and the one being computed, GMRES vectors and blocks of the whole matrix
+            memory = 2 * n * neighbours * 16 * self.SPARSE_FILL_IN + 8 * (self.SPARSE_ITERATIONS * (n + 1) + 2 ** 21)
+            return n * neighbours ** 2 + self.SPARSE_ITERATIONS * n ** 2, int(memory)
+
+        # Distance matrix, the kept factorization and the one being computed
+        return n ** 3, 3 * (n + 1) ** 2 * np.dtype(self._system_dtype(molecule)).itemsize
+
+    def _system_dtype(self, molecule: Molecule) -> type:
+        return molecule.dtype if len(molecule) >= self.SINGLE_PRECISION_MIN_ATOMS else np.float_
+
+    def release(self, molecule: Molecule):
+        self._factorizations.pop(molecule.name, None)
+
+    def _factorize(self, molecule: Molecule, kappa: float, hardness: np.ndarray, double: bool = False):
+        # The EEM matrix depends only on kappa and B, so its factorization is reused
+        # as long as they stay the same and only the right-hand side (A) changes
+        cached = self._factorizations.setdefault(molecule.name, [])
+        for k, entry in enumerate(cached):
+            if entry[0] == kappa and np.array_equal(entry[1], hardness):
+                if not double or not isinstance(entry[2], tuple) or entry[2][0].dtype == np.float_:
+                    cached.append(cached.pop(k))
+                    return entry[2:]
+
+        # Make room before factorizing, so that no more than the kept factorizations exist at once
+        if len(cached) >= self.FACTORIZATIONS_PER_MOLECULE:
+            cached.pop(0)
+
+        if self._is_sparse(molecule):
+            factorization, failure = self._factorize_sparse(molecule, kappa, hardness)
+            cached.append((kappa, hardness, factorization, failure))
+            return factorization, failure
 
         n = len(molecule.atoms)
-        matrix = np.empty((n + 1, n + 1), dtype=np.float_)
-        vector = np.empty(n + 1, dtype=np.float_)
+        if molecule.dtype != np.float_ and (double or self._system_dtype(molecule) == np.float_):
+            # The single precision distance matrix of the molecule is not needed for a double precision system
+            distance_matrix = scipy.spatial.distance.cdist(molecule.coordinates, molecule.coordinates)
+        else:
+            distance_matrix = molecule.distance_matrix
+
+        factorization = None
+        if np.count_nonzero(distance_matrix) < n * (n - 1):
+            failure = CalculationFailure('coincident atoms', None)
+        else:
+            # Single precision geometry gives a single precision system
+            matrix = np.empty((n + 1, n + 1), dtype=distance_matrix.dtype)
+
+            # The zeros on the diagonal are overwritten right away
+            with np.errstate(divide='ignore'):
+                matrix[:n, :n] = kappa / distance_matrix
+            matrix[np.arange(n), np.arange(n)] = hardness
+
+            matrix[n, :] = 1.0
+            matrix[:, n] = 1.0
+            matrix[n, n] = 0.0
+
+            getrf, gecon = scipy.linalg.get_lapack_funcs(('getrf', 'gecon'), (matrix,))
+            norm = np.abs(matrix).sum(axis=0).max()
+            lu, piv, info = getrf(matrix, overwrite_a=True)
+            if info != 0 or not np.isfinite(norm):
+                failure = CalculationFailure('singular matrix', None)
+            else:
+                # O(n^2) estimate using the factorization
+                rcond, _ = gecon(lu, norm)
+                if rcond < self.MIN_RCOND:
+                    failure = CalculationFailure('ill-conditioned matrix', float(rcond))
+                else:
+                    factorization, failure = (lu, piv), None
+
+        cached.append((kappa, hardness, factorization, failure))
+        return factorization, failure
+
+    def _factorize_sparse(self, molecule: Molecule, kappa: float, hardness: np.ndarray):
+        """Factorize the system with interactions of atoms closer than the cutoff only"""
+        n = len(molecule.atoms)
+        tree = scipy.spatial.cKDTree(molecule.coordinates)
+        i, j = tree.query_pairs(self._cutoff, output_type='ndarray').T
+        distances = np.linalg.norm(molecule.coordinates[i] - molecule.coordinates[j], axis=1)
+        if not distances.all():
+            return None, CalculationFailure('coincident atoms', None)
+
+        diagonal = np.arange(n)
+        border = np.full(n, n)
+        rows = np.concatenate((i, j, diagonal, diagonal, border))
+        columns = np.concatenate((j, i, diagonal, border, diagonal))
+        data = np.concatenate((kappa / distances, kappa / distances, hardness, np.ones(2 * n)))
+        matrix = scipy.sparse.csc_matrix((data, (rows, columns)), shape=(n + 1, n + 1))
+
+        try:
+            factorization = scipy.sparse.linalg.splu(matrix)
+        except RuntimeError:
+            return None, CalculationFailure('singular matrix', None)
+
+        # Estimate of the 1-norm of the inverse from a few solutions, like gecon does for dense matrices
+        inverse = scipy.sparse.linalg.LinearOperator(matrix.shape, matvec=factorization.solve,
+                                                     rmatvec=lambda x: factorization.solve(x, trans='T'))
+        rcond = 1.0 / (scipy.sparse.linalg.norm(matrix, 1) * scipy.sparse.linalg.onenormest(inverse))
+        if not rcond >= self.MIN_RCOND:
+            return None, CalculationFailure('ill-conditioned matrix', float(rcond))
+
+        return factorization, None
+
+    @staticmethod
+    def _product(molecule: Molecule, kappa: float, hardness: np.ndarray, x: np.ndarray) -> np.ndarray:
+        """Product of the system matrix and x in double precision, the matrix is built from coordinates by blocks"""
+        n = len(molecule.atoms)
+        product = np.empty(n + 1, dtype=np.float_)
+        block = max(1, 2 ** 20 // n)
+        for start in range(0, n, block):
+            stop = min(start + block, n)
+            with np.errstate(divide='ignore'):
+                rows = kappa / scipy.spatial.distance.cdist(molecule.coordinates[start:stop], molecule.coordinates)
+            rows[np.arange(stop - start), np.arange(start, stop)] = hardness[start:stop]
+            product[start:stop] = rows @ x[:n] + x[n]
+
+        product[n] = x[:n].sum()
+        return product
 
-        matrix[:n, :n] = self.parameters.common['kappa'] / molecule.distance_matrix
+    def _solve_refined(self, molecule: Molecule, solve: Callable[[np.ndarray], np.ndarray], kappa: float,
+                       hardness: np.ndarray, vector: np.ndarray):
+        """Solve the system approximately followed by iterative refinement in double precision"""
+        x = solve(vector)
+        tolerance = self.REFINEMENT_TOLERANCE * np.abs(vector).max()
+        for step in range(self.REFINEMENT_STEPS + 1):
+            residual = vector - self._product(molecule, kappa, hardness, x)
+            if np.abs(residual).max() <= tolerance:
+                return x
+            if step < self.REFINEMENT_STEPS:
+                x += solve(residual)
+
+        return None
+
+    def _solve_sparse(self, molecule: Molecule, factorization: scipy.sparse.linalg.SuperLU, kappa: float,
+                      hardness: np.ndarray, vector: np.ndarray):
+        """Solve the whole system by GMRES preconditioned by the sparse factorization with cutoff"""
+        shape = (len(molecule.atoms) + 1,) * 2
+        matrix = scipy.sparse.linalg.LinearOperator(shape, matvec=lambda x: self._product(molecule, kappa, hardness, x))
+        preconditioner = scipy.sparse.linalg.LinearOperator(shape, matvec=factorization.solve)
+
+        def solve(b: np.ndarray) -> np.ndarray:
+            # Convergence is judged by the residual of the refinement
+            x, _ = scipy.sparse.linalg.gmres(matrix, b, M=preconditioner, restart=self.SPARSE_ITERATIONS, maxiter=1,
+                                             atol=0.0)
+            return x
+
+        return self._solve_refined(molecule, solve, kappa, hardness, vector)
+
+    def _atom_parameters(self, molecule: Molecule) -> Tuple[np.ndarray, np.ndarray]:
+        n = len(molecule.atoms)
+        hardness = np.fromiter((self.parameters.atom['B'](atom) for atom in molecule.atoms), dtype=np.float_, count=n)
+        vector = np.empty(n + 1, dtype=np.float_)
         for i, atom_i in enumerate(molecule.atoms):
-            matrix[i, i] = self.parameters.atom['B'](atom_i)
             vector[i] = - self.parameters.atom['A'](atom_i)
-
-        matrix[n, :] = 1.0
-        matrix[:, n] = 1.0
-        matrix[n, n] = 0.0
         vector[n] = molecule.formal_charge
 
-        try:
-            return np.linalg.solve(matrix, vector)[:-1]
-        except np.linalg.LinAlgError:
-            return np.full(len(molecule), np.nan, dtype=np.float_)
+        return hardness, vector
+
+    def calculate_ensemble_charges(self, ensemble: Ensemble) -> np.ndarray:
+        # Parameters are looked up once, each conformer has its own system with all the checks
+        hardness, vector = self._atom_parameters(ensemble.molecule)
+        charges = np.empty((len(ensemble), len(ensemble.molecule)), dtype=np.float_)
+        for k, conformer in enumerate(ensemble.conformers):
+            charges[k] = self._solve(conformer, hardness, vector)
+            self.release(conformer)
+
+        return charges
+
+    def calculate_charges(self, molecule: Molecule):
+        hardness, vector = self._atom_parameters(molecule)
+        return self._solve(molecule, hardness, vector)
+
+    def _solve(self, molecule: Molecule, hardness: np.ndarray, vector: np.ndarray) -> np.ndarray:
+        kappa = self.parameters.common['kappa']
+        factorization, failure = self._factorize(molecule, kappa, hardness)
+        if failure is not None:
+            return self.report_failure(molecule, *failure)
+
+        solution = None
+        if isinstance(factorization, scipy.sparse.linalg.SuperLU):
+            solution = self._solve_sparse(molecule, factorization, kappa, hardness, vector)
+            if solution is None:
+                return self.report_failure(molecule, 'no convergence')
+        elif factorization[0].dtype != np.float_:
+            dtype = factorization[0].dtype
+            solution = self._solve_refined(molecule, lambda b: scipy.linalg.lu_solve(
+                factorization, b.astype(dtype), check_finite=False).astype(np.float_), kappa, hardness, vector)
+            if solution is None:
+                factorization, failure = self._factorize(molecule, kappa, hardness, double=True)
+                if failure is not None:
+                    return self.report_failure(molecule, *failure)
+
+        if solution is None:
+            solution = scipy.linalg.lu_solve(factorization, vector, check_finite=False)
+
+        charges = solution[:-1]
+        if not np.isfinite(charges).all():
+            return self.report_failure(molecule, 'non-finite charges')
+
+        self.failures.pop(molecule.name, None)
+        return charges
@@ -2,15 +2,43 @@ import argparse
 import importlib
 from collections import namedtuple
 
+import numpy as np
+
 from charge_method import get_charge_methods
 from classifier import classifiers
+from writers import writers
 
 CommandLineOption = namedtuple('CommandLineOption', 'name help type default')
 
+precisions = {'single': np.float32, 'double': np.float_}
+
+
+def shard(value: str):
+    try:
+        index, count = map(int, value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('Shard has to be specified as INDEX/COUNT')
+
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError('Shard index has to be between 0 and COUNT - 1')
+
+    return index, count
+
+
+def method_with_parameters(value: str):
+    name, _, par_file = value.partition(':')
+    if name not in get_charge_methods():
+        raise argparse.ArgumentTypeError('Unknown method: {}'.format(name))
+
+    return name, par_file or None
+
 
 def parse_arguments():
     common_parser = argparse.ArgumentParser(add_help=False, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     common_parser.add_argument('--classifier', choices=classifiers.keys(), default='plain')
+    common_parser.add_argument('--processes', type=int, default=1, help='Number of processes loading molecules')
+    common_parser.add_argument('--precision', choices=precisions.keys(), default='double',
+                               help='Precision of distance matrices and charge calculation systems')
     common_parser.add_argument('-v', '--verbose', action='store_true', default=False)
     common_parser.add_argument('--debug', action='store_true', default=False)
 
@@ -23,6 +51,8 @@ def parse_arguments():
 
     charges_parser = subparsers.add_parser('charges', help='Calculate charges')
     parameterization_parser = subparsers.add_parser('parameters', help='Parameterize method')
+    merge_parser = subparsers.add_parser('merge', help='Merge charges calculated for separate shards')
+    multi_parser = subparsers.add_parser('multi', help='Calculate charges by several methods in one pass')
 
     method_subparsers = charges_parser.add_subparsers(dest='method')
     for method in get_charge_methods():
@@ -32,6 +62,25 @@ def parse_arguments():
                                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
         method_parser.add_argument('sdf_file', help='SDF file')
         method_parser.add_argument('charges_outfile', help='File for outputting charges')
+        method_parser.add_argument('--shard', type=shard, metavar='INDEX/COUNT', default=None,
+                                   help='Process only the INDEX-th of COUNT equally sized parts of the SDF file')
+        method_parser.add_argument('--failures', default=None,
+                                   help='JSON file for molecules whose charges could not be calculated')
+        method_parser.add_argument('--format', choices=writers.keys(), default='json',
+                                   help='Format of the output, SDF keeps the original records')
+        method_parser.add_argument('--workers', type=int, default=1,
+                                   help='Number of processes calculating charges, the largest molecules go first')
+        method_parser.add_argument('--max-memory', type=int, metavar='MB', default=None,
+                                   help='Memory available for calculations running at the same time')
+        method_parser.add_argument('--pipeline', action='store_true', default=False,
+                                   help='Read, load, calculate and write molecules in concurrent threads')
+        method_parser.add_argument('--conformers', choices=['all', 'uniform', 'boltzmann'], default=None,
+                                   help='Treat consecutive records with the same name and topology as conformers '
+                                        'and output charges of all of them or their average')
+        method_parser.add_argument('--energy-field', default='energy',
+                                   help='SDF data item with energies of conformers (kcal/mol) for Boltzmann weights')
+        method_parser.add_argument('--temperature', type=float, default=298.15,
+                                   help='Temperature (K) of Boltzmann weights')
 
         for option in m.ChargeMethod.OPTIONS:
             method_parser.add_argument('--' + option.name, dest='method_' + option.name, metavar=option.name.upper(),
@@ -40,6 +89,31 @@ def parse_arguments():
     parameterization_parser.add_argument('method', choices=get_charge_methods(), help='Charge calculation method')
     parameterization_parser.add_argument('sdf_file', help='SDF file')
     parameterization_parser.add_argument('charge_file', help='File with reference charges')
+    parameterization_parser.add_argument('--workers', type=int, default=1,
+                                         help='Number of processes evaluating the objective function')
+    parameterization_parser.add_argument('--report', default=None,
+                                         help='CSV file for statistics of each molecule after parameterization, '
+                                              'of each test molecule with the parameters of its fold if --folds')
+    parameterization_parser.add_argument('--failures', default=None,
+                                         help='JSON file for molecules whose charges could not be calculated')
+    parameterization_parser.add_argument('--folds', type=int, default=None,
+                                         help='Cross-validate with this many folds stratified by atom types, '
+                                              'the folds are parameterized by --workers processes at once')
+    parameterization_parser.add_argument('--seed', type=int, default=None,
+                                         help='Seed of the random split into folds and of initial parameters')
+
+    merge_parser.add_argument('charges_outfile', help='File for outputting merged charges')
+    merge_parser.add_argument('charge_files', nargs='+', help='Files with charges of the shards (in order)')
+
+    multi_parser.add_argument('sdf_file', help='SDF file')
+    multi_parser.add_argument('outdir', help='Directory for outputting charges, one file per method')
+    multi_parser.add_argument('methods', nargs='+', type=method_with_parameters, metavar='METHOD[:PAR_FILE]',
+                              help='Charge calculation methods, optionally with their parameter files')
+    multi_parser.add_argument('--shard', type=shard, metavar='INDEX/COUNT', default=None,
+                              help='Process only the INDEX-th of COUNT equally sized parts of the SDF file')
+    multi_parser.add_argument('--failures', action='store_true', default=False,
+                              help='Store molecules whose charges could not be calculated by each method '
+                                   'to NAME_failures.json in the output directory')
 
     args = parser.parse_args()
 
@@ -1,14 +1,22 @@
+import concurrent.futures
+import multiprocessing
 import operator
+from collections import Counter
 from copy import deepcopy
+from multiprocessing.connection import Connection
+from typing import List, Tuple, Dict, TextIO
 
 import numpy as np
 import scipy.optimize
 
-from charge_method import ChargeMethodSkeleton
+from charge_method import ChargeMethodSkeleton, CalculationFailure
 from charges import Charges
-from statistics import calculate_statistics
+from statistics import calculate_statistics, sum_all_total, StatisticsAccumulator, Statistics
 from structures.molecule_set import MoleculeSet
 
+# Step of the forward differences, the same one L-BFGS-B uses when approximating the gradient itself
+GRADIENT_STEP = 1e-8
+
 
 def run_one_iter(data: np.ndarray, molecules: MoleculeSet, method: ChargeMethodSkeleton, ref_charges: Charges):
     method.parameters.load_packed(data)
@@ -21,23 +29,191 @@ def run_one_iter(data: np.ndarray, molecules: MoleculeSet, method: ChargeMethodS
     return rmsd
 
 
-def one_process(molecules: MoleculeSet, method: ChargeMethodSkeleton, ref_charges: Charges):
+def evaluate_part(connection: Connection, molecules: MoleculeSet, method: ChargeMethodSkeleton, ref_charges: Charges):
+    """Worker loop: receive parameter vectors, send back partial RMSD sums and molecule counts for each of them"""
+    while True:
+        points = connection.recv()
+        if points is None:
+            break
+
+        results = np.empty((len(points), 2), dtype=np.float_)
+        for k, data in enumerate(points):
+            method.parameters.load_packed(data)
+            new_charges = Charges({molecule.name: method.calculate_charges(molecule) for molecule in molecules})
+            totals, count = sum_all_total(ref_charges, new_charges)
+            results[k] = totals.rmsd, count
+
+        connection.send(results)
+
+    connection.close()
+
+
+class DistributedObjective:
+    """Objective of the parameterization evaluated by worker processes, each holding its part of the set resident.
+
+    Returns the same value as run_one_iter together with its forward difference gradient,
+    so that each optimizer step takes a single round trip to the workers."""
+
+    def __init__(self, molecules: MoleculeSet, method: ChargeMethodSkeleton, ref_charges: Charges, workers: int):
+        # Balance the parts by the cost of the dense solve
+        parts: List[List[int]] = [[] for _ in range(workers)]
+        costs = [0] * workers
+        for i in sorted(range(len(molecules)), key=lambda idx: len(molecules[idx]), reverse=True):
+            k = costs.index(min(costs))
+            parts[k].append(i)
+            costs[k] += len(molecules[i]) ** 3
+
+        self._connections: List[Connection] = []
+        self._processes: List[multiprocessing.Process] = []
+        for part in parts:
+            part_molecules = MoleculeSet(molecules[i] for i in sorted(part))
+            part_charges = Charges({molecule.name: ref_charges[molecule.name] for molecule in part_molecules})
+            parent_connection, child_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=evaluate_part,
+                                              args=(child_connection, part_molecules, method, part_charges),
+                                              daemon=True)
+            process.start()
+            child_connection.close()
+            self._connections.append(parent_connection)
+            self._processes.append(process)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _evaluate(self, points: List[np.ndarray]) -> np.ndarray:
+        for connection in self._connections:
+            connection.send(points)
+
+        rmsd, count = sum(connection.recv() for connection in self._connections).T
+        return rmsd / (count + 1)  # +1 the same way as in calculate_all_total
+
+    def __call__(self, data: np.ndarray) -> Tuple[float, np.ndarray]:
+        points = [data]
+        for i in range(len(data)):
+            point = data.copy()
+            point[i] += GRADIENT_STEP
+            points.append(point)
+
+        values = self._evaluate(points)
+        return values[0], (values[1:] - values[0]) / GRADIENT_STEP
+
+    def close(self):
+        for connection in self._connections:
+            connection.send(None)
+            connection.close()
+
+        for process in self._processes:
+            process.join()
+
+
+def one_process(molecules: MoleculeSet, method: ChargeMethodSkeleton, ref_charges: Charges, workers: int = 1):
     method.parameters.set_random_values()
     method.parameters.print_parameters()
     x0 = method.parameters.pack_values()
-    return scipy.optimize.minimize(run_one_iter, x0, args=(molecules, method, ref_charges), method='L-BFGS-B',
-                                   options={'maxiter': 10})
+    if workers > 1:
+        with DistributedObjective(molecules, method, ref_charges, workers) as objective:
+            result = scipy.optimize.minimize(objective, x0, jac=True, method='L-BFGS-B', options={'maxiter': 10})
+    else:
+        result = scipy.optimize.minimize(run_one_iter, x0, args=(molecules, method, ref_charges), method='L-BFGS-B',
+                                         options={'maxiter': 10})
 
+    method.parameters.load_packed(result.x)
+    return result
 
-def parameterize(molecules: MoleculeSet, method: ChargeMethodSkeleton, ref_charges: Charges):
+
+def parameterize(molecules: MoleculeSet, method: ChargeMethodSkeleton, ref_charges: Charges, workers: int = 1):
     population_size = 1
     population = [deepcopy(method) for _ in range(population_size)]
 
     results = []
     for m in population:
-        results.append(one_process(molecules, m, ref_charges))
+        results.append(one_process(molecules, m, ref_charges, workers))
 
     results = [result.fun for result in results]
     index, value = min(enumerate(results), key=operator.itemgetter(1))
 
     method.parameters.load_packed(population[index].parameters.pack_values())
+
+
+def stratified_folds(molecules: MoleculeSet, folds: int, seed: int = None) -> List[List[int]]:
+    """Split indices of the molecules into folds so that each atom type is spread over as many of them as possible.
+
+    Molecules are grouped by their rarest atom type and each group is dealt out to the folds in turn."""
+    type_counts = Counter(atom_type for molecule in molecules for atom_type in {atom.atom_type for atom in molecule})
+    groups: Dict[tuple, List[int]] = {}
+    for i, molecule in enumerate(molecules):
+        rarest = min((atom.atom_type for atom in molecule), key=lambda atom_type: (type_counts[atom_type], atom_type))
+        groups.setdefault(rarest, []).append(i)
+
+    random_state = np.random.RandomState(seed)
+    parts: List[List[int]] = [[] for _ in range(folds)]
+    k = 0
+    for rarest in sorted(groups, key=lambda atom_type: (type_counts[atom_type], atom_type)):
+        for i in random_state.permutation(groups[rarest]):
+            parts[k].append(int(i))
+            k = (k + 1) % folds
+
+    return [sorted(part) for part in parts]
+
+
+_molecules: MoleculeSet = None
+_method: ChargeMethodSkeleton = None
+_ref_charges: Charges = None
+
+
+def _set_cross_validation(molecules: MoleculeSet, method: ChargeMethodSkeleton, ref_charges: Charges):
+    global _molecules, _method, _ref_charges
+    _molecules, _method, _ref_charges = molecules, method, ref_charges
+
+
+def cross_validate_fold(train: List[int], test: List[int],
+                        seed: int = None) -> Tuple[StatisticsAccumulator, Dict[str, CalculationFailure]]:
+    """Worker part: parameterize on the training molecules, return statistics of the test ones
+    and the test molecules whose charges could not be calculated"""
+    np.random.seed(seed)
+    method = deepcopy(_method)
+    train_molecules = _molecules.subset(train)
+    train_charges = Charges({molecule.name: _ref_charges[molecule.name] for molecule in train_molecules})
+    parameterize(train_molecules, method, train_charges)
+
+    method.failures.clear()
+    accumulator = StatisticsAccumulator(keep_rows=True)
+    for i in test:
+        molecule = _molecules[i]
+        accumulator.add(molecule, _ref_charges[molecule.name], method.calculate_charges(molecule))
+        method.release(molecule)
+
+    return accumulator, dict(method.failures)
+
+
+def cross_validate(molecules: MoleculeSet, method: ChargeMethodSkeleton, ref_charges: Charges, folds: int,
+                   workers: int = 1, seed: int = None,
+                   report: TextIO = None) -> Tuple[List[Statistics], StatisticsAccumulator]:
+    """K-fold cross-validation of the parameterization, folds are parameterized concurrently by worker processes.
+
+    The parameters of the method have to be initialized from the whole set, so that each fold
+    has parameters also for atom types missing from its training molecules.
+    Test molecules are written to the report fold by fold, those whose charges could not be calculated
+    with the parameters of their fold are kept in the failures of the method.
+    Return total statistics of each fold and the statistics of all test molecules together."""
+    parts = stratified_folds(molecules, folds, seed)
+    method.failures.clear()
+    accumulator = StatisticsAccumulator(report)
+    fold_statistics = []
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_set_cross_validation,
+                                                initargs=(molecules, method, ref_charges)) as executor:
+        futures = []
+        for k, test in enumerate(parts):
+            train = [i for j, part in enumerate(parts) if j != k for i in part]
+            futures.append(executor.submit(cross_validate_fold, train, test, None if seed is None else seed + k))
+
+        for future in futures:
+            fold_accumulator, failures = future.result()
+            fold_statistics.append(fold_accumulator.total())
+            accumulator.merge(fold_accumulator)
+            method.failures.update(failures)
+
+    return fold_statistics, accumulator
@@ -101,8 +101,9 @@ class Parameters:
             idx += 1
 
         for parameter in self.atom:
-            for value in parameter[3:]:
-                packed[idx] = value
+            values = self.atom.parameter_values(parameter)
+            for name in self.atom.parameter_names:
+                packed[idx] = getattr(values, name)
                 idx += 1
 
         return packed
@@ -110,12 +111,10 @@ class Parameters:
     def load_packed(self, packed: np.ndarray):
         assert len(packed) == self.size
 
-        start = 0
         for i, key in enumerate(self.common):
             self.common[key] = packed[i]
-            start = i
 
-        self.atom.update_values(packed[start:])
+        self.atom.update_values(packed[len(self.common):])
 
     def print_parameters(self):
         print('Common parameters:')
@@ -180,6 +179,20 @@ class AtomParameters:
 
         return f
 
+    def __getstate__(self):
+        # The type of the parameters is created dynamically and cannot be pickled
+        values = []
+        for parameter in self:
+            values.append((*parameter, list(self.parameter_values(parameter).__dict__.values())))
+
+        return self.parameter_names, values
+
+    def __setstate__(self, state):
+        parameter_names, values = state
+        self.__init__(parameter_names)
+        for element, classifier, atom_type, parameters in values:
+            self.add_parameter(element, classifier, atom_type, parameters)
+
     @property
     def data(self):
         return self._parameters
@@ -0,0 +1,144 @@
+import queue
+import sys
+import threading
+from typing import Iterable, Callable, Iterator, List, Tuple
+
+import numpy as np
+
+from charge_method import ChargeMethodSkeleton
+from classifier import Classifier
+from structures.molecule import Molecule
+from structures.molecule_set import read_records, classify, shard_range
+
+# Items waiting between two stages, a stage is blocked when its output queue is full
+QUEUE_SIZE = 64
+
+# How often (in seconds) blocked stages check whether the pipeline was stopped
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+class _Failure:
+    """Exception raised in a stage, passed down the pipeline and raised again by its consumer"""
+
+    def __init__(self, exception: BaseException) -> None:
+        self.exception = exception
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=POLL_INTERVAL)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            pass
+
+    return _DONE
+
+
+def _produce(source: Iterable, target: queue.Queue, stop: threading.Event):
+    try:
+        for item in source:
+            if not _put(target, item, stop):
+                return
+    except BaseException as e:
+        _put(target, _Failure(e), stop)
+        return
+
+    _put(target, _DONE, stop)
+
+
+def _process(function: Callable, source: queue.Queue, target: queue.Queue, stop: threading.Event):
+    while True:
+        item = _get(source, stop)
+        if item is _DONE or isinstance(item, _Failure):
+            _put(target, item, stop)
+            return
+
+        try:
+            result = function(item)
+        except BaseException as e:
+            _put(target, _Failure(e), stop)
+            return
+
+        if not _put(target, result, stop):
+            return
+
+
+def pipeline(source: Iterable, *stages: Callable, queue_size: int = QUEUE_SIZE) -> Iterator:
+    """Pass items of the source through the stages, each running in its own thread, and yield the results in order.
+
+    The source is iterated in a thread as well. Stages are connected by queues of at most queue_size items,
+    so a slow stage holds back the ones before it. Exceptions raised in the threads are raised again here."""
+    stop = threading.Event()
+    queues = [queue.Queue(queue_size) for _ in range(len(stages) + 1)]
+    threads = [threading.Thread(target=_produce, args=(source, queues[0], stop), daemon=True)]
+    for function, source_queue, target_queue in zip(stages, queues, queues[1:]):
+        threads.append(threading.Thread(target=_process, args=(function, source_queue, target_queue, stop),
+                                        daemon=True))
+
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = queues[-1].get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Failure):
+                raise item.exception
+
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+
+def calculate_pipelined(filename: str, method: ChargeMethodSkeleton, shard: Tuple[int, int] = None,
+                        classifier: Classifier = None, dtype: type = np.float_,
+                        records: bool = False) -> Iterator[Tuple[List[str], Molecule, np.ndarray]]:
+    """Yield molecules of the SDF file with their charges, overlapping reading, loading and classification,
+    and calculation of the charges. Each molecule comes with its SDF record if requested."""
+    try:
+        start, end = shard_range(filename, shard)
+    except IOError:
+        print('Cannot open SDF file: {}'.format(filename), file=sys.stderr)
+        sys.exit(1)
+
+    molecule_names = set()
+
+    def load(mol_record: List[str]) -> Tuple[List[str], Molecule]:
+        molecule = Molecule.create_from_mol(mol_record, dtype)
+        if molecule.name in molecule_names:
+            raise RuntimeError('Two molecules with the same name! ({})'.format(molecule.name))
+        else:
+            molecule_names.add(molecule.name)
+
+        if classifier is not None:
+            classify(molecule, classifier)
+
+        return mol_record if records else None, molecule
+
+    def calculate(loaded: Tuple[List[str], Molecule]) -> Tuple[List[str], Molecule, np.ndarray]:
+        mol_record, molecule = loaded
+        charges = method.calculate_charges(molecule)
+        method.release(molecule)
+        return mol_record, molecule, charges
+
+    try:
+        yield from pipeline(read_records(filename, start, end), load, calculate)
+    except IOError:
+        print('Cannot open SDF file: {}'.format(filename), file=sys.stderr)
+        sys.exit(1)
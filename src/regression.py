@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""Compare the optimized ways of calculating EEM charges with the straightforward dense solution.
+
+Each path runs on generated molecules and on the given SDF files. Its charges have to agree with
+the reference within the tolerance. Molecules whose reference charges are not finite have to fail,
+the others may fail only if the failure is reported (e.g. coincident atoms, which the original code
+solved anyway). Run times and speedups are stored in a JSON report, the exit status is nonzero
+if any check fails."""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from typing import Dict, List, Callable
+
+import numpy as np
+
+from charge_method import CalculationFailure
+from charges import Charges
+from classifier import ParametersClassifier
+from methods.eem import ChargeMethod
+from parameterization import DistributedObjective, run_one_iter, GRADIENT_STEP
+from pipeline import calculate_pipelined
+from scheduler import calculate_scheduled
+from statistics import StatisticsAccumulator, calculate_all_total, calculate_all_per_atom_type
+from structures.ensemble import iterate_ensembles
+from structures.molecule_set import MoleculeSet
+from writers import JsonWriter
+
+Result = namedtuple('Result', 'check set max_diff tolerance nan_mismatches reported_failures reference_time time '
+                               'speedup passed')
+
+# Shard counts whose merged charges are compared with the whole set
+SHARD_COUNTS = (2, 3, 7)
+
+# Molecules used to compare the distributed objective with the serial one
+OBJECTIVE_MOLECULES = 100
+
+ELEMENTS = ['C', 'C', 'C', 'N', 'O', 'S']
+
+
+def generate_molecule(name: str, heavy_atoms: int, random_state: np.random.RandomState, conformers: int = 1,
+                      coincident: bool = False) -> str:
+    """SDF records of a random chain-like molecule with hydrogens, one record per conformer"""
+    elements = [random_state.choice(ELEMENTS) for _ in range(heavy_atoms)]
+    bonds = []
+    for i in range(1, heavy_atoms):
+        order = 2 if elements[i] in ('N', 'O') and random_state.rand() < 0.3 else 1
+        bonds.append((random_state.randint(max(0, i - 3), i), i, order))
+
+    for i in range(heavy_atoms):
+        for _ in range(random_state.randint(0, 3)):
+            elements.append('H')
+            bonds.append((i, len(elements) - 1, 1))
+
+    charge = 1 if random_state.rand() < 0.2 else 0
+    base = np.cumsum(random_state.uniform(-1.2, 1.2, (len(elements), 3)), axis=0)
+    records = []
+    for _ in range(conformers):
+        coordinates = base + random_state.uniform(-0.3, 0.3, base.shape)
+        if coincident:
+            coordinates[-1] = coordinates[0]
+
+        lines = [name, '  regression', '', '{:3d}{:3d}  0  0  0  0  0  0  0  0999 V2000'.format(len(elements),
+                                                                                                len(bonds))]
+        for element, (x, y, z) in zip(elements, coordinates):
+            lines.append('{:10.4f}{:10.4f}{:10.4f} {:<3s} 0  0  0  0  0  0  0  0  0  0  0  0'.format(x, y, z, element))
+        for atom1, atom2, order in bonds:
+            lines.append('{:3d}{:3d}{:3d}  0'.format(atom1 + 1, atom2 + 1, order))
+        if charge:
+            lines.append('M  CHG  1   1{:4d}'.format(charge))
+        lines.extend(['M  END', '$$$$', ''])
+        records.append('\n'.join(lines))
+
+    return ''.join(records)
+
+
+def generate_set(filename: str, count: int, seed: int, conformers: int = 1):
+    """Molecules of up to about 400 atoms, every tenth has two coincident atoms"""
+    random_state = np.random.RandomState(seed)
+    with open(filename, 'w') as f:
+        for k in range(count):
+            f.write(generate_molecule('mol{}'.format(k), random_state.randint(3, 150), random_state, conformers,
+                                      coincident=k % 10 == 9))
+
+
+def create_method(**options) -> ChargeMethod:
+    method = ChargeMethod()
+    method_options = {option.name: option.default for option in method.OPTIONS}
+    method_options.update(options)
+    method.initialize(method_options)
+    return method
+
+
+def reference_charges(method: ChargeMethod, molecule) -> np.ndarray:
+    """Charges by solving the whole EEM system at once, the way it was originally done"""
+    n = len(molecule.atoms)
+    matrix = np.empty((n + 1, n + 1), dtype=np.float_)
+    vector = np.empty(n + 1, dtype=np.float_)
+
+    with np.errstate(divide='ignore'):
+        matrix[:n, :n] = method.parameters.common['kappa'] / molecule.distance_matrix.astype(np.float_)
+    for i, atom_i in enumerate(molecule.atoms):
+        matrix[i, i] = method.parameters.atom['B'](atom_i)
+        vector[i] = - method.parameters.atom['A'](atom_i)
+
+    matrix[n, :] = 1.0
+    matrix[:, n] = 1.0
+    matrix[n, n] = 0.0
+    vector[n] = molecule.formal_charge
+
+    try:
+        return np.linalg.solve(matrix, vector)[:-1]
+    except np.linalg.LinAlgError:
+        return np.full(n, np.nan, dtype=np.float_)
+
+
+def timed(function: Callable):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def compare(check: str, set_name: str, reference: Dict[str, np.ndarray], reference_time: float,
+            charges: Dict[str, np.ndarray], elapsed: float, tolerance: float = None,
+            failures: Dict[str, CalculationFailure] = None) -> Result:
+    """Differences of charges are relative to the largest reference charge of the molecule, but at least 1.
+
+    Without a tolerance the difference is only recorded."""
+    failures = failures if failures is not None else {}
+    max_diff = 0.0
+    nan_mismatches = 0
+    reported_failures = 0
+    for name, x in reference.items():
+        y = charges.get(name)
+        if y is None or len(x) != len(y):
+            nan_mismatches += 1
+            continue
+
+        x_failed = not np.isfinite(x).all()
+        y_failed = not np.isfinite(y).all()
+        if x_failed != y_failed:
+            if y_failed and name in failures:
+                reported_failures += 1
+            else:
+                nan_mismatches += 1
+            continue
+
+        if not x_failed:
+            scale = max(1.0, float(np.abs(x).max()))
+            max_diff = max(max_diff, float(np.abs(x - y).max()) / scale)
+
+    nan_mismatches += len(set(charges) - set(reference))
+    passed = (tolerance is None or max_diff <= tolerance) and nan_mismatches == 0
+    speedup = reference_time / elapsed if elapsed > 0 else float('inf')
+    return Result(check, set_name, max_diff, tolerance, nan_mismatches, reported_failures, reference_time, elapsed,
+                  speedup, passed)
+
+
+def calculate_all(method: ChargeMethod, molecules: MoleculeSet, release: bool = True) -> Dict[str, np.ndarray]:
+    charges = {}
+    for molecule in molecules:
+        charges[molecule.name] = method.calculate_charges(molecule)
+        if release:
+            method.release(molecule)
+
+    return charges
+
+
+def check_set(set_name: str, filename: str, workers: int, processes: int) -> List[Result]:
+    # Each path gets its own method, so that only its own failures are taken into account
+    method = create_method()
+    classifier = ParametersClassifier(method.parameters.atom)
+    molecules, load_time = timed(lambda: MoleculeSet.load_from_file(filename, classifier=classifier))
+
+    reference, reference_time = timed(lambda: {molecule.name: reference_charges(method, molecule)
+                                               for molecule in molecules})
+    results = []
+
+    charges, elapsed = timed(lambda: calculate_all(method, molecules))
+    results.append(compare('dense', set_name, reference, reference_time, charges, elapsed, 1e-10, method.failures))
+    dense_charges = charges
+
+    # The second pass reuses the factorizations kept from the first one
+    cached_method = create_method()
+    calculate_all(cached_method, molecules, release=False)
+    charges, elapsed = timed(lambda: calculate_all(cached_method, molecules, release=False))
+    results.append(compare('cached', set_name, reference, reference_time, charges, elapsed, 1e-10,
+                           cached_method.failures))
+
+    single = MoleculeSet.load_from_file(filename, classifier=classifier, dtype=np.float32)
+    single_method = create_method()
+    charges, elapsed = timed(lambda: calculate_all(single_method, single))
+    results.append(compare('float32', set_name, reference, reference_time, charges, elapsed, 1e-6,
+                           single_method.failures))
+
+    # Refinement of single precision systems is checked on all molecules, not only on the large ones
+    refined_method = create_method()
+    refined_method.SINGLE_PRECISION_MIN_ATOMS = 0
+    single = MoleculeSet.load_from_file(filename, classifier=classifier, dtype=np.float32)
+    charges, elapsed = timed(lambda: calculate_all(refined_method, single))
+    results.append(compare('refined', set_name, reference, reference_time, charges, elapsed, 1e-6,
+                           refined_method.failures))
+
+    # With the cutoff longer than any distance the sparse system is the same as the dense one,
+    # only pivoting of the sparse factorization differs
+    sparse_method = create_method(sparse_limit=0, cutoff=1e6)
+    charges, elapsed = timed(lambda: calculate_all(sparse_method, molecules))
+    results.append(compare('sparse', set_name, reference, reference_time, charges, elapsed, 1e-6,
+                           sparse_method.failures))
+
+    # With the default cutoff the sparse factorization only preconditions the iterative solution,
+    # which is refined to the same residual as the single precision one
+    cutoff_method = create_method(sparse_limit=0)
+    charges, elapsed = timed(lambda: calculate_all(cutoff_method, molecules))
+    results.append(compare('cutoff', set_name, reference, reference_time, charges, elapsed, 1e-6,
+                           cutoff_method.failures))
+
+    scheduled_method = create_method()
+    charges, elapsed = timed(lambda: {molecule.name: c for molecule, c in calculate_scheduled(molecules,
+                                                                                              scheduled_method,
+                                                                                              workers)})
+    results.append(compare('scheduled', set_name, reference, reference_time, charges, elapsed, 1e-10,
+                           scheduled_method.failures))
+
+    pipeline_method = create_method()
+    charges, elapsed = timed(lambda: {molecule.name: c for _, molecule, c in calculate_pipelined(
+        filename, pipeline_method, classifier=classifier)})
+    results.append(compare('pipeline', set_name, reference, reference_time, charges, elapsed, 1e-10,
+                           pipeline_method.failures))
+
+    results.append(check_parallel_loading(set_name, filename, molecules, load_time, reference, processes))
+    results.extend(check_shards(set_name, filename, molecules, reference, reference_time))
+    results.append(check_io(set_name, molecules, reference))
+    results.append(check_statistics(set_name, molecules, reference, dense_charges))
+    results.append(check_objective(set_name, molecules, dense_charges, workers))
+    return results
+
+
+def check_parallel_loading(set_name: str, filename: str, molecules: MoleculeSet, load_time: float,
+                           reference: Dict[str, np.ndarray], processes: int) -> Result:
+    """Molecules loaded by worker processes in chunks have to be the same ones, in the same order"""
+    method = create_method()
+    classifier = ParametersClassifier(method.parameters.atom)
+    loaded, elapsed = timed(lambda: MoleculeSet.load_from_file(filename, classifier=classifier,
+                                                               processes=processes))
+    charges = calculate_all(method, loaded)
+    result = compare('processes', set_name, reference, load_time, charges, elapsed, 1e-10, method.failures)
+    same_order = [molecule.name for molecule in loaded] == [molecule.name for molecule in molecules]
+    same_types = all(atom1.atom_type == atom2.atom_type
+                     for molecule1, molecule2 in zip(loaded, molecules) for atom1, atom2 in zip(molecule1, molecule2))
+    return result._replace(passed=result.passed and same_order and same_types)
+
+
+def check_shards(set_name: str, filename: str, molecules: MoleculeSet, reference: Dict[str, np.ndarray],
+                 reference_time: float) -> List[Result]:
+    """Charges of shards merged together have to cover each molecule exactly once, in the original order"""
+    results = []
+    for count in SHARD_COUNTS:
+        method = create_method()
+        classifier = ParametersClassifier(method.parameters.atom)
+
+        def calculate_shards():
+            shards = []
+            for index in range(count):
+                shards.append(Charges({molecule.name: method.calculate_charges(molecule)
+                                       for _, molecule in MoleculeSet.iterate_file(filename, (index, count),
+                                                                                   classifier)}))
+            return Charges.merge(shards)
+
+        try:
+            merged, elapsed = timed(calculate_shards)
+        except RuntimeError:
+            results.append(Result('shards_{}'.format(count), set_name, np.nan, 1e-10, len(reference), 0,
+                                  reference_time, np.nan, np.nan, False))
+            continue
+
+        result = compare('shards_{}'.format(count), set_name, reference, reference_time,
+                         {name: merged[name] for name in merged}, elapsed, 1e-10, method.failures)
+        same_order = list(merged) == [molecule.name for molecule in molecules]
+        results.append(result._replace(passed=result.passed and same_order))
+
+    return results
+
+
+def check_objective(set_name: str, molecules: MoleculeSet, charges: Dict[str, np.ndarray], workers: int) -> Result:
+    """The distributed objective has to give the same value and forward difference gradient as run_one_iter"""
+    subset = molecules.subset(range(min(len(molecules), OBJECTIVE_MOLECULES)))
+    ref_charges = Charges({molecule.name: charges[molecule.name] for molecule in subset})
+    method = create_method()
+
+    # Move away from the parameters giving the reference charges, so that the objective is not zero
+    x = method.parameters.pack_values() * (1 + 0.05 * np.random.RandomState(0).uniform(-1, 1, method.parameters.size))
+
+    def serial():
+        value = run_one_iter(x, subset, method, ref_charges)
+        gradient = np.empty(len(x), dtype=np.float_)
+        for i in range(len(x)):
+            point = x.copy()
+            point[i] += GRADIENT_STEP
+            gradient[i] = (run_one_iter(point, subset, method, ref_charges) - value) / GRADIENT_STEP
+        return value, gradient
+
+    def distributed():
+        with DistributedObjective(subset, method, ref_charges, workers) as objective:
+            return objective(x)
+
+    (value, gradient), reference_time = timed(serial)
+    (distributed_value, distributed_gradient), elapsed = timed(distributed)
+    return compare('objective', set_name, {'value': np.array([value]), 'gradient': gradient}, reference_time,
+                   {'value': np.array([distributed_value]), 'gradient': distributed_gradient}, elapsed, 1e-5)
+
+
+def check_ensembles(set_name: str, filename: str) -> List[Result]:
+    """Conformers of ensembles solved together have to get the same charges as each of them alone"""
+    method = create_method()
+    classifier = ParametersClassifier(method.parameters.atom)
+    ensembles = list(iterate_ensembles(filename, classifier))
+
+    reference, reference_time = timed(lambda: {conformer.name: reference_charges(method, conformer)
+                                               for ensemble in ensembles for conformer in ensemble.conformers})
+
+    def calculate_all():
+        charges = {}
+        for ensemble in ensembles:
+            charges.update(zip((conformer.name for conformer in ensemble.conformers),
+                               method.calculate_ensemble_charges(ensemble)))
+        return charges
+
+    charges, elapsed = timed(calculate_all)
+    return [compare('ensemble', set_name, reference, reference_time, charges, elapsed, 1e-10, method.failures)]
+
+
+def check_io(set_name: str, molecules: MoleculeSet, reference: Dict[str, np.ndarray]) -> Result:
+    """Charges written by JsonWriter and by Charges.save_to_file have to load back the same"""
+    with tempfile.TemporaryDirectory() as directory:
+        saved_file = os.path.join(directory, 'saved.json')
+        streamed_file = os.path.join(directory, 'streamed.json')
+        _, reference_time = timed(lambda: Charges(reference).save_to_file(saved_file))
+
+        def stream():
+            with JsonWriter(streamed_file) as writer:
+                for molecule in molecules:
+                    writer.write(molecule, None, reference[molecule.name])
+
+        _, elapsed = timed(stream)
+        with open(saved_file) as saved, open(streamed_file) as streamed:
+            identical = saved.read() == streamed.read()
+
+        loaded = Charges.load_from_file(streamed_file)
+        result = compare('charges_io', set_name, reference, reference_time, {name: loaded[name] for name in loaded},
+                         elapsed, 0.0)
+
+    return result._replace(passed=result.passed and identical)
+
+
+def check_statistics(set_name: str, molecules: MoleculeSet, reference: Dict[str, np.ndarray],
+                     charges: Dict[str, np.ndarray]) -> Result:
+    """Streamed and merged statistics have to agree with the ones calculated from all charges at once"""
+    ref_charges = Charges(reference)
+    new_charges = Charges(charges)
+
+    def at_once():
+        return calculate_all_total(ref_charges, new_charges), calculate_all_per_atom_type(molecules, ref_charges,
+                                                                                          new_charges)
+
+    def streamed():
+        parts = [StatisticsAccumulator(), StatisticsAccumulator()]
+        for i, molecule in enumerate(molecules):
+            parts[i % 2].add(molecule, reference[molecule.name], charges[molecule.name])
+        parts[0].merge(parts[1])
+        return parts[0].total(), parts[0].per_atom_type()
+
+    (expected_total, expected_types), reference_time = timed(at_once)
+    (total, types), elapsed = timed(streamed)
+
+    expected = {'total': np.array(expected_total)}
+    actual = {'total': np.array(total)}
+    for atom_type, values in expected_types.items():
+        expected[str(atom_type)] = np.array(values)
+        actual[str(atom_type)] = np.array(types[atom_type]) if atom_type in types else np.array([])
+
+    return compare('statistics', set_name, expected, reference_time, actual, elapsed, 1e-10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Regression of optimized EEM calculations',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('sdf_files', nargs='*', help='Additional SDF files to check')
+    parser.add_argument('--ensembles', nargs='*', default=[], metavar='SDF_FILE',
+                        help='Additional SDF files with conformers to check')
+    parser.add_argument('--molecules', type=int, default=200, help='Number of generated molecules')
+    parser.add_argument('--conformers', type=int, default=3, help='Conformers of each generated ensemble')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the generated molecules')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Processes of the scheduled calculation and of the distributed objective')
+    parser.add_argument('--processes', type=int, default=3, help='Processes loading molecules in parallel')
+    parser.add_argument('--report', default='regression.json', help='JSON file for the results')
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        generated = os.path.join(directory, 'generated.sdf')
+        generate_set(generated, args.molecules, args.seed)
+        results.extend(check_set('generated', generated, args.workers, args.processes))
+
+        ensembles = os.path.join(directory, 'ensembles.sdf')
+        generate_set(ensembles, max(1, args.molecules // args.conformers), args.seed + 1, args.conformers)
+        results.extend(check_ensembles('generated_ensembles', ensembles))
+
+    for filename in args.sdf_files:
+        results.extend(check_set(os.path.basename(filename), filename, args.workers, args.processes))
+
+    for filename in args.ensembles:
+        results.extend(check_ensembles(os.path.basename(filename), filename))
+
+    print('{:<12s} {:<22s} {:>10s} {:>6s} {:>9s} {:>9s} {:>8s}'.format('Check', 'Set', 'Max diff', 'NaN', 'Reported',
+                                                                       'Speedup', 'Result'))
+    for result in results:
+        print('{:<12s} {:<22s} {:>10.2e} {:>6d} {:>9d} {:>9.2f} {:>8s}'.format(
+            result.check, result.set, result.max_diff, result.nan_mismatches, result.reported_failures,
+            result.speedup, ('ok' if result.tolerance is not None else 'recorded') if result.passed else 'FAILED'))
+
+    try:
+        with open(args.report, 'w') as f:
+            json.dump([result._asdict() for result in results], f, indent=2)
+    except IOError:
+        print('Cannot store report to file: {}'.format(args.report), file=sys.stderr)
+        sys.exit(1)
+
+    if not all(result.passed for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
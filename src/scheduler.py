@@ -0,0 +1,110 @@
+import concurrent.futures
+from collections import deque, namedtuple
+from typing import List, Iterator, Tuple, Dict
+
+import numpy as np
+
+from charge_method import ChargeMethodSkeleton, CalculationFailure
+from structures.molecule import Molecule
+from structures.molecule_set import MoleculeSet
+
+# Molecules cheaper than this (relative time, about a dense system of 100 atoms) are sent to workers in batches
+BATCH_COST = 100 ** 3
+
+Task = namedtuple('Task', 'indices cost memory')
+
+_method: ChargeMethodSkeleton = None
+
+
+def _set_method(method: ChargeMethodSkeleton):
+    global _method
+    _method = method
+
+
+def calculate_batch(molecules: List[Molecule]) -> Tuple[List[np.ndarray], Dict[str, CalculationFailure]]:
+    """Worker part: calculate charges of the molecules, freeing everything kept for them afterwards"""
+    _method.failures.clear()
+    charges = []
+    for molecule in molecules:
+        charges.append(_method.calculate_charges(molecule))
+        _method.release(molecule)
+
+    return charges, dict(_method.failures)
+
+
+def create_tasks(molecules: MoleculeSet, method: ChargeMethodSkeleton,
+                 max_memory: int) -> Tuple[List[Task], Dict[int, np.ndarray]]:
+    """Split the molecules into tasks ordered by their estimated cost, the most expensive first.
+
+    Molecules which do not fit into max_memory are returned separately with NaN charges."""
+    costs = [method.estimate_cost(molecule) for molecule in molecules]
+    order = sorted(range(len(molecules)), key=lambda i: costs[i][0], reverse=True)
+
+    tasks = []
+    skipped = {}
+    batch = []
+    batch_cost = 0
+    batch_memory = 0
+    for i in order:
+        cost, memory = costs[i]
+        if max_memory is not None and memory > max_memory:
+            skipped[i] = method.report_failure(molecules[i], 'insufficient memory', memory)
+            continue
+
+        if cost >= BATCH_COST:
+            tasks.append(Task([i], cost, memory))
+            continue
+
+        # Molecules of a batch are calculated one after another, so it needs the memory of the largest one
+        batch.append(i)
+        batch_cost += cost
+        batch_memory = max(batch_memory, memory)
+        if batch_cost >= BATCH_COST:
+            tasks.append(Task(batch, batch_cost, batch_memory))
+            batch, batch_cost, batch_memory = [], 0, 0
+
+    if batch:
+        tasks.append(Task(batch, batch_cost, batch_memory))
+
+    return tasks, skipped
+
+
+def calculate_scheduled(molecules: MoleculeSet, method: ChargeMethodSkeleton, workers: int = 1,
+                        max_memory: int = None) -> Iterator[Tuple[Molecule, np.ndarray]]:
+    """Calculate charges by the worker processes, the largest molecules first.
+
+    Tasks are started only while their estimated memory fits into max_memory (in bytes) together
+    with the running ones. Molecules that would not fit even alone are reported as failures.
+    Charges are yielded in the order of the molecules in the set."""
+    tasks, skipped = create_tasks(molecules, method, max_memory)
+    tasks = deque(tasks)
+    results: Dict[int, np.ndarray] = skipped
+    next_index = 0
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_set_method, initargs=(method,)) as executor:
+        running = {}
+        used_memory = 0
+        while tasks or running:
+            # Keep the order of the tasks, the first one waits until there is enough memory for it
+            while tasks and len(running) < workers and \
+                    (max_memory is None or used_memory + tasks[0].memory <= max_memory):
+                task = tasks.popleft()
+                future = executor.submit(calculate_batch, [molecules[i] for i in task.indices])
+                running[future] = task
+                used_memory += task.memory
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                used_memory -= task.memory
+                charges, failures = future.result()
+                results.update(zip(task.indices, charges))
+                method.failures.update(failures)
+
+            while next_index in results:
+                yield molecules[next_index], results.pop(next_index)
+                next_index += 1
+
+    # Only molecules not fitting into memory may remain
+    while next_index in results:
+        yield molecules[next_index], results.pop(next_index)
+        next_index += 1
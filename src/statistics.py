@@ -1,8 +1,11 @@
-from collections import namedtuple
+import csv
+from collections import namedtuple, defaultdict
+from typing import Tuple, Dict, TextIO, List
 
 import numpy as np
 
 from charges import Charges
+from structures.molecule import Molecule
 from structures.molecule_set import MoleculeSet
 
 
@@ -23,7 +26,12 @@ def corrcoef(x1: np.ndarray, x2: np.ndarray):
     return np.dot(x1m, x2m) ** 2 / (np.dot(x1m, x1m) * np.dot(x2m, x2m))
 
 
-def calculate_all_total(ref_charges: Charges, charges: Charges) -> Statistics:
+def calculate_molecule(x1: np.ndarray, x2: np.ndarray) -> Statistics:
+    abs_diff = np.abs(x1 - x2)
+    return Statistics((mean(abs_diff ** 2)) ** 0.5, corrcoef(x1, x2), mean(abs_diff), abs_diff.max())
+
+
+def sum_all_total(ref_charges: Charges, charges: Charges) -> Tuple[Statistics, int]:
     np.seterr(divide='ignore', invalid='ignore')
     total_rmsd = 0
     total_pearson2 = 0
@@ -34,20 +42,25 @@ def calculate_all_total(ref_charges: Charges, charges: Charges) -> Statistics:
     for molecule_name in ref_charges:
         x1 = ref_charges[molecule_name]
         x2 = charges[molecule_name]
-        if np.isnan(x2[0]) or np.isnan(x1[0]):
+        if np.isnan(x2).any() or np.isnan(x1).any():
             bad_molecules += 1
             continue
 
-        abs_diff = np.abs(x1 - x2)
+        molecule_statistics = calculate_molecule(x1, x2)
 
-        total_pearson2 += corrcoef(x1, x2)
-        total_rmsd += (mean(abs_diff ** 2)) ** 0.5
-        total_avg_diff += mean(abs_diff)
-        total_max_diff += abs_diff.max()
+        total_rmsd += molecule_statistics.rmsd
+        total_pearson2 += molecule_statistics.pearson2
+        total_avg_diff += molecule_statistics.avg_diff
+        total_max_diff += molecule_statistics.max_diff
 
-    n = len(ref_charges) - bad_molecules + 1  # +1 to avoid zero if all molecules are bad
+    return Statistics(total_rmsd, total_pearson2, total_avg_diff, total_max_diff), len(ref_charges) - bad_molecules
+
+
+def calculate_all_total(ref_charges: Charges, charges: Charges) -> Statistics:
+    totals, count = sum_all_total(ref_charges, charges)
+    n = count + 1  # +1 to avoid zero if all molecules are bad
 
-    return Statistics(total_rmsd / n, total_pearson2 / n, total_avg_diff / n, total_max_diff / n)
+    return Statistics(*(value / n for value in totals))
 
 
 def calculate_all_per_atom_type(molecules: MoleculeSet, ref_charges: Charges, charges: Charges) -> dict:
@@ -66,11 +79,16 @@ def calculate_all_per_atom_type(molecules: MoleculeSet, ref_charges: Charges, ch
             x[idx] = ref_charges[name][j]
             y[idx] = charges[name][j]
 
+        # Atoms of molecules whose charges could not be calculated are left out
+        valid = ~(np.isnan(x) | np.isnan(y))
+        x = x[valid]
+        y = y[valid]
+
         abs_diff = np.abs(x - y)
         rmsd = (mean(abs_diff ** 2)) ** 0.5
         pearson2 = corrcoef(x, y)
         avg_diff = mean(abs_diff)
-        max_diff = abs_diff.max()
+        max_diff = abs_diff.max() if len(abs_diff) else np.nan
 
         results[atom_type] = Statistics(rmsd, pearson2, avg_diff, max_diff)
 
@@ -82,3 +100,129 @@ def calculate_statistics(molecules: MoleculeSet, ref_charges: Charges, charges:
     per_atom_type_results = calculate_all_per_atom_type(molecules, ref_charges, charges)
 
     return total_results.rmsd
+
+
+class StatisticsAccumulator:
+    """Statistics updated molecule by molecule, so that the charges need not be kept in memory.
+
+    Per atom type values are merged with the parallel variant of Welford's algorithm."""
+
+    # n, mean x, mean y, M2 x, M2 y, co-moment, sum of squared differences, sum of differences, max difference
+    _N, _MX, _MY, _M2X, _M2Y, _CXY, _SSD, _SAD, _MAX = range(9)
+
+    def __init__(self, report: TextIO = None, keep_rows: bool = False) -> None:
+        self._total = np.zeros(4, dtype=np.float_)
+        self._count = 0
+        self._per_atom_type: Dict[tuple, np.ndarray] = {}
+        # Rows of the report written by the accumulator this one is merged into, e.g. in another process
+        self._rows: List[tuple] = [] if keep_rows else None
+
+        self._report = None
+        if report is not None:
+            self._report = csv.writer(report)
+            self._report.writerow(('name', 'atoms') + Statistics._fields)
+
+    def add(self, molecule: Molecule, x1: np.ndarray, x2: np.ndarray) -> Statistics:
+        """Add reference charges x1 and calculated charges x2 of a molecule, return its statistics"""
+        np.seterr(divide='ignore', invalid='ignore')
+        indices = defaultdict(list)
+        for j, atom in enumerate(molecule):
+            indices[atom.atom_type].append(j)
+
+        for atom_type, idx in indices.items():
+            self._add_atom_type(atom_type, x1[idx], x2[idx])
+
+        molecule_statistics = calculate_molecule(x1, x2)
+        if not (np.isnan(x2).any() or np.isnan(x1).any()):
+            self._total += molecule_statistics
+            self._count += 1
+
+        row = (molecule.name, len(molecule)) + molecule_statistics
+        if self._report is not None:
+            self._report.writerow(row)
+        if self._rows is not None:
+            self._rows.append(row)
+
+        return molecule_statistics
+
+    def _add_atom_type(self, atom_type: tuple, x: np.ndarray, y: np.ndarray):
+        valid = ~(np.isnan(x) | np.isnan(y))
+        x = x[valid]
+        y = y[valid]
+        if not len(x):
+            self._per_atom_type.setdefault(atom_type, np.zeros(9, dtype=np.float_))
+            return
+
+        b = np.zeros(9, dtype=np.float_)
+        abs_diff = np.abs(x - y)
+        b[self._N] = len(x)
+        b[self._MX] = mean(x)
+        b[self._MY] = mean(y)
+        b[self._M2X] = np.dot(x - b[self._MX], x - b[self._MX])
+        b[self._M2Y] = np.dot(y - b[self._MY], y - b[self._MY])
+        b[self._CXY] = np.dot(x - b[self._MX], y - b[self._MY])
+        b[self._SSD] = np.dot(abs_diff, abs_diff)
+        b[self._SAD] = abs_diff.sum()
+        b[self._MAX] = abs_diff.max()
+        self._merge_atom_type(atom_type, b)
+
+    def _merge_atom_type(self, atom_type: tuple, b: np.ndarray):
+        try:
+            a = self._per_atom_type[atom_type]
+        except KeyError:
+            self._per_atom_type[atom_type] = b.copy()
+            return
+
+        nb = b[self._N]
+        if not nb:
+            return
+
+        n = a[self._N] + nb
+        dx = b[self._MX] - a[self._MX]
+        dy = b[self._MY] - a[self._MY]
+        weight = a[self._N] * nb / n
+
+        a[self._MX] += dx * nb / n
+        a[self._MY] += dy * nb / n
+        a[self._M2X] += b[self._M2X] + dx * dx * weight
+        a[self._M2Y] += b[self._M2Y] + dy * dy * weight
+        a[self._CXY] += b[self._CXY] + dx * dy * weight
+        a[self._SSD] += b[self._SSD]
+        a[self._SAD] += b[self._SAD]
+        a[self._MAX] = np.maximum(a[self._MAX], b[self._MAX])
+        a[self._N] = n
+
+    def merge(self, other: 'StatisticsAccumulator'):
+        """Add all molecules of the other accumulator, e.g. one filled in another process"""
+        if other._rows is not None:
+            if self._report is not None:
+                self._report.writerows(other._rows)
+            if self._rows is not None:
+                self._rows.extend(other._rows)
+
+        self._total += other._total
+        self._count += other._count
+        for atom_type, b in other._per_atom_type.items():
+            self._merge_atom_type(atom_type, b)
+
+    def __getstate__(self):
+        # The report is written only by the accumulator that created it
+        state = self.__dict__.copy()
+        state['_report'] = None
+        return state
+
+    def total(self) -> Statistics:
+        n = self._count + 1  # +1 the same way as in calculate_all_total
+        return Statistics(*(self._total / n))
+
+    def per_atom_type(self) -> dict:
+        np.seterr(divide='ignore', invalid='ignore')
+        results = dict()
+        for atom_type, a in self._per_atom_type.items():
+            n = a[self._N]
+            rmsd = (a[self._SSD] / n) ** 0.5
+            pearson2 = a[self._CXY] ** 2 / (a[self._M2X] * a[self._M2Y])
+            max_diff = a[self._MAX] if n else np.nan
+            results[atom_type] = Statistics(rmsd, pearson2, a[self._SAD] / n, max_diff)
+
+        return results
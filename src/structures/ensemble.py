@@ -0,0 +1,141 @@
+import sys
+from typing import List, Generator
+
+import numpy as np
+
+from classifier import Classifier
+from structures.molecule import Molecule
+from structures.molecule_set import read_records, classify
+
+# Gas constant in kcal/(mol K)
+GAS_CONSTANT = 0.0019872041
+
+
+class Ensemble:
+    """Conformers of one molecule, sharing its name, atoms, their types and topology; only coordinates differ.
+
+    Conformers are named NAME#K once there is more than one of them."""
+
+    def __init__(self, molecule: Molecule, mol_record: List[str]) -> None:
+        self._molecule: Molecule = molecule
+        self._conformers: List[Molecule] = [molecule]
+        self._records: List[List[str]] = [mol_record]
+        self._topology: List[str] = self.topology(mol_record)
+
+    def __len__(self):
+        return len(self._conformers)
+
+    def __str__(self):
+        return 'Ensemble({}, conformers={})'.format(self.name, len(self))
+
+    @property
+    def name(self):
+        return self._molecule.name
+
+    @property
+    def molecule(self):
+        return self._molecule
+
+    @property
+    def conformers(self):
+        return self._conformers
+
+    @property
+    def records(self):
+        return self._records
+
+    def conformer_name(self, index: int) -> str:
+        return '{}#{}'.format(self.name, index + 1)
+
+    @staticmethod
+    def topology(mol_record: List[str]) -> List[str]:
+        """Text of a V2000 MOL record except for coordinates: atom and bond counts, the atom block without
+        coordinates, the bond block and properties (such as formal charges)"""
+        atom_count, bond_count = int(mol_record[3][0:3]), int(mol_record[3][3:6])
+        topology = [mol_record[3][0:6]]
+        topology.extend(line[30:].rstrip() for line in mol_record[4:4 + atom_count])
+        for line in mol_record[4 + atom_count:]:
+            topology.append(line.rstrip())
+            if line.startswith('M  END'):
+                break
+
+        return topology
+
+    def is_conformer(self, mol_record: List[str]) -> bool:
+        """Whether the SDF record has the same name and, compared as text, the same topology"""
+        return mol_record[0].strip() == self.name and self.topology(mol_record) == self._topology
+
+    def add_conformer(self, mol_record: List[str]):
+        """Add a conformer whose topology was checked by is_conformer, only its coordinates are read"""
+        if len(self) == 1:
+            self._conformers[0] = self._molecule.with_coordinates(self.conformer_name(0), self._molecule.coordinates)
+        self._conformers.append(self._molecule.with_coordinates(self.conformer_name(len(self)),
+                                                                Molecule.coordinates_from_mol(mol_record)))
+        self._records.append(mol_record)
+
+    def energies(self, field: str) -> np.ndarray:
+        """Energies of the conformers read from the given data item of their SDF records"""
+        energies = np.empty(len(self), dtype=np.float_)
+        for k, mol_record in enumerate(self._records):
+            lines = iter(mol_record)
+            for line in lines:
+                if line.startswith('>') and '<{}>'.format(field) in line:
+                    energies[k] = float(next(lines))
+                    break
+            else:
+                raise RuntimeError('No energy {} for conformer {}'.format(field, self._conformers[k].name))
+
+        return energies
+
+
+def boltzmann_weights(energies: np.ndarray, temperature: float) -> np.ndarray:
+    """Boltzmann weights of conformers with energies in kcal/mol"""
+    return np.exp(-(energies - energies.min()) / (GAS_CONSTANT * temperature))
+
+
+def average_charges(charges: np.ndarray, weights: np.ndarray = None) -> np.ndarray:
+    """Weighted average of charges of conformers, those whose charges could not be calculated are left out"""
+    if weights is None:
+        weights = np.ones(len(charges), dtype=np.float_)
+
+    valid = ~np.isnan(charges).any(axis=1)
+    if not valid.any():
+        return np.full(charges.shape[1], np.nan, dtype=np.float_)
+
+    return weights[valid] @ charges[valid] / weights[valid].sum()
+
+
+def iterate_ensembles(filename: str, classifier: Classifier = None,
+                      dtype: type = np.float_) -> Generator[Ensemble, None, None]:
+    """Yield ensembles of consecutive SDF records with the same name and topology.
+
+    Only the first record of an ensemble is read whole, the following ones just for coordinates."""
+    names = set()
+    ensemble = None
+    try:
+        for mol_record in read_records(filename):
+            if ensemble is not None and ensemble.is_conformer(mol_record):
+                ensemble.add_conformer(mol_record)
+                continue
+
+            if ensemble is not None:
+                yield ensemble
+
+            molecule = Molecule.create_from_mol(mol_record, dtype)
+
+            if molecule.name in names:
+                raise RuntimeError('Two molecules with the same name! ({})'.format(molecule.name))
+            else:
+                names.add(molecule.name)
+
+            # Conformers share the atoms, so they are classified only once
+            if classifier is not None:
+                classify(molecule, classifier)
+
+            ensemble = Ensemble(molecule, mol_record)
+    except IOError:
+        print('Cannot open SDF file: {}'.format(filename), file=sys.stderr)
+        sys.exit(1)
+
+    if ensemble is not None:
+        yield ensemble
@@ -1,3 +1,4 @@
+import copy
 from collections import namedtuple
 from typing import List, Generator
 
@@ -11,7 +12,8 @@ Bond = namedtuple('Bond', 'atom1 atom2 order'.split())
 
 
 class Molecule:
-    def __init__(self, name: str, atoms: List[Atom], bonds: List[Bond]) -> None:
+    def __init__(self, name: str, atoms: List[Atom], bonds: List[Bond], distance_matrix: np.ndarray = None,
+                 dtype: type = np.float_) -> None:
         self._name: str = name
         self._atoms: List[Atom] = atoms
         self._formal_charge: int = sum(atom.formal_charge for atom in self.atoms)
@@ -19,15 +21,18 @@ class Molecule:
         n = len(self)
         self._hbo: np.ndarray = np.zeros(n, dtype=np.int8)
         self._connectivity_matrix: np.ndarray = np.zeros((n, n), dtype=np.int8)
-        for atom1_idx, atom2_idx, order in bonds:
-            order = np.int8(order)
+        if len(bonds):
+            atom1_idx, atom2_idx, order = np.array(bonds, dtype=np.int64).T
+            order = order.astype(np.int8)
             self._connectivity_matrix[atom1_idx, atom2_idx] = order
             self._connectivity_matrix[atom2_idx, atom1_idx] = order
-            self._hbo[atom1_idx] = self._hbo[atom1_idx] if self._hbo[atom1_idx] > order else order
-            self._hbo[atom2_idx] = self._hbo[atom2_idx] if self._hbo[atom2_idx] > order else order
+            np.maximum.at(self._hbo, atom1_idx, order)
+            np.maximum.at(self._hbo, atom2_idx, order)
 
-        atom_coords = np.array([atom.coordinates for atom in self.atoms])
-        self._distance_matrix: np.ndarray = scipy.spatial.distance.cdist(atom_coords, atom_coords)
+        self._coordinates: np.ndarray = np.array([atom.coordinates for atom in self.atoms], dtype=np.float_)
+        self._dtype: type = dtype if distance_matrix is None else distance_matrix.dtype.type
+        # Calculated on first use, large molecules need not have it at all
+        self._distance_matrix: np.ndarray = distance_matrix
 
     def __getitem__(self, item):
         return self.atoms[item]
@@ -49,12 +54,35 @@ class Molecule:
     def atoms(self):
         return self._atoms
 
+    @property
+    def coordinates(self):
+        return self._coordinates
+
+    @property
+    def dtype(self):
+        return self._dtype
+
     @property
     def distance_matrix(self):
+        if self._distance_matrix is None:
+            distance_matrix = scipy.spatial.distance.cdist(self._coordinates, self._coordinates)
+            self._distance_matrix = distance_matrix.astype(self._dtype, copy=False)
         return self._distance_matrix
 
+    @property
+    def connectivity_matrix(self):
+        return self._connectivity_matrix
+
+    def with_coordinates(self, name: str, coordinates: np.ndarray) -> 'Molecule':
+        """Conformer of the molecule sharing its atoms (including their types) and topology"""
+        conformer = copy.copy(self)
+        conformer._name = name
+        conformer._coordinates = coordinates
+        conformer._distance_matrix = None
+        return conformer
+
     def distance(self, atom1: Atom, atom2: Atom, units: str = 'angstrom') -> float:
-        dist = self._distance_matrix[atom1.index, atom2.index]
+        dist = self.distance_matrix[atom1.index, atom2.index]
         if units == 'au':
             dist *= 1.8897259885789
         return dist
@@ -62,9 +90,9 @@ class Molecule:
     @property
     def bonds(self):
         for i, atom_i in enumerate(self.atoms):
-            for j, atom_j in enumerate(self.atoms[i:]):
+            for j, atom_j in enumerate(self.atoms[i + 1:], start=i + 1):
                 if self._connectivity_matrix[i, j] > 0:
-                    yield Bond(atom_i, atom_j, self._connectivity_matrix[i, j])
+                    yield Bond(atom_i, atom_j, int(self._connectivity_matrix[i, j]))
 
     @property
     def formal_charge(self) -> int:
@@ -80,8 +108,15 @@ class Molecule:
     def is_bonded(self, atom1: Atom, atom2: Atom):
         return self._connectivity_matrix[atom1.index, atom2.index] > 0
 
+    @staticmethod
+    def coordinates_from_mol(mol_record) -> np.ndarray:
+        """Coordinates of atoms of a V2000 MOL record, nothing else is read"""
+        atom_count = int(mol_record[3][0:3])
+        return np.array([(float(line[0:10]), float(line[10:20]), float(line[20:30]))
+                         for line in mol_record[4:4 + atom_count]], dtype=np.float_)
+
     @classmethod
-    def create_from_mol(cls, mol_record):
+    def create_from_mol(cls, mol_record, dtype: type = np.float_):
 
         def read_mol_v2000(data):
             counts_line = data[3]
@@ -138,4 +173,4 @@ class Molecule:
         else:
             raise RuntimeError('Incorrect version of MOL record: {}'.format(version))
 
-        return Molecule(name, atoms, bonds)
+        return Molecule(name, atoms, bonds, dtype=dtype)
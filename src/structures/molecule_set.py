@@ -1,12 +1,172 @@
+import concurrent.futures
+import os
 import sys
-from collections import Counter, defaultdict
-from typing import List
+from collections import Counter, defaultdict, deque
+from typing import List, Generator, Tuple, Dict, Iterator, Iterable
 
-from classifier import Classifier, classifiers
+import numpy as np
+
+from classifier import Classifier, ParametersClassifier, classifiers, classify_multiple
 from pte import periodic_table
+from structures.atom import Atom
 from structures.molecule import Molecule
 
 
+# Approximate size of the parts of SDF files loaded by the worker processes
+CHUNK_SIZE = 2 ** 22
+
+
+def read_records(filename: str, start: int = 0, end: int = None) -> Generator[List[str], None, None]:
+    """Yield SDF records whose first line starts within the byte range [start, end)"""
+    with open(filename, 'rb') as f:
+        if start > 0:
+            # Records start right after a '$$$$' line; look for the first one ending at or after start.
+            # Back off a bit so that a '$$$$' line straddling start is read whole.
+            offset = max(0, start - 1 - 1024)
+            f.seek(offset)
+            if offset > 0:
+                f.readline()
+            for line in iter(f.readline, b''):
+                if line.strip() == b'$$$$' and f.tell() >= start:
+                    break
+            else:
+                return
+
+        mol_record = []
+        record_start = f.tell()
+        while end is None or record_start < end:
+            line = f.readline()
+            if not line:
+                break
+
+            if line.strip() == b'$$$$':
+                yield mol_record
+                mol_record = []
+                record_start = f.tell()
+                continue
+
+            mol_record.append(line.decode())
+
+
+def shard_range(filename: str, shard: Tuple[int, int] = None) -> Tuple[int, int]:
+    """Byte range of the SDF file belonging to the shard (INDEX, COUNT), the whole file if there is none"""
+    start, end = 0, os.path.getsize(filename)
+    if shard is not None:
+        index, count = shard
+        start, end = end * index // count, end * (index + 1) // count
+
+    return start, end
+
+
+def classify(molecule: Molecule, classifier: Classifier):
+    for atom in molecule:
+        atom.atom_type = atom.element.symbol, *classifier.get_type(molecule, atom)
+
+
+def load_part(filename: str, start: int, end: int, classifier: Classifier = None, dtype: type = np.float_,
+              records: bool = False):
+    """Load and classify molecules within the byte range, return them as flat arrays instead of objects.
+
+    Distance matrices are not sent back, the molecules calculate them when they are needed."""
+    names = []
+    sizes = []
+    bond_counts = []
+    numbers = []
+    coordinates = []
+    charges = []
+    bonds = []
+    atom_types = []
+    type_indices = {}
+    mol_records = []
+    for mol_record in read_records(filename, start, end):
+        molecule = Molecule.create_from_mol(mol_record, dtype)
+        if classifier is not None:
+            classify(molecule, classifier)
+
+        names.append(molecule.name)
+        sizes.append(len(molecule))
+        for atom in molecule:
+            numbers.append(atom.element.number)
+            coordinates.append(atom.coordinates)
+            charges.append(atom.formal_charge)
+            if classifier is not None:
+                atom_types.append(type_indices.setdefault(atom.atom_type, len(type_indices)))
+
+        i, j = np.nonzero(np.triu(molecule.connectivity_matrix))
+        bonds.append(np.column_stack((i, j, molecule.connectivity_matrix[i, j])))
+        bond_counts.append(len(i))
+        if records:
+            mol_records.append(mol_record)
+
+    arrays = {
+        'sizes': np.array(sizes, dtype=np.int64),
+        'bond_counts': np.array(bond_counts, dtype=np.int64),
+        'numbers': np.array(numbers, dtype=np.int16),
+        'coordinates': np.array(coordinates, dtype=np.float_).reshape(-1, 3),
+        'charges': np.array(charges, dtype=np.int16),
+        'bonds': np.concatenate(bonds) if bonds else np.empty((0, 3), dtype=np.int64),
+        'atom_types': np.array(atom_types, dtype=np.int32),
+    }
+
+    return names, arrays, list(type_indices), mol_records
+
+
+def molecules_from_arrays(names: List[str], arrays: Dict[str, np.ndarray], atom_types: List[tuple],
+                          dtype: type = np.float_) -> List[Molecule]:
+    elements = {element.number: element for element in periodic_table.values()}
+    numbers = arrays['numbers'].tolist()
+    coordinates = arrays['coordinates'].tolist()
+    charges = arrays['charges'].tolist()
+    types = [atom_types[k] for k in arrays['atom_types'].tolist()]
+
+    molecules = []
+    atom_offset = 0
+    bond_offset = 0
+    for name, n, m in zip(names, arrays['sizes'].tolist(), arrays['bond_counts'].tolist()):
+        atoms = [Atom(elements[numbers[k]], k - atom_offset, coordinates[k], charges[k])
+                 for k in range(atom_offset, atom_offset + n)]
+        for atom, atom_type in zip(atoms, types[atom_offset:atom_offset + n]):
+            atom.atom_type = atom_type
+
+        bonds = arrays['bonds'][bond_offset:bond_offset + m]
+        molecules.append(Molecule(name, atoms, bonds, dtype=dtype))
+
+        atom_offset += n
+        bond_offset += m
+
+    return molecules
+
+
+def load_parallel(filename: str, start: int, end: int, classifier: Classifier, processes: int,
+                  dtype: type = np.float_, records: bool = False) -> Generator[Tuple[List[str], Molecule], None, None]:
+    """Load molecules within the byte range in worker processes, each parsing and classifying its chunk.
+
+    Molecules are yielded in order, with only a few chunks processed ahead."""
+    chunks = max(processes * 4, (end - start) // CHUNK_SIZE)
+    starts = [start + (end - start) * k // chunks for k in range(chunks)]
+    ends = starts[1:] + [end]
+
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        pending = deque()
+        for chunk_start, chunk_end in zip(starts, ends):
+            pending.append(executor.submit(load_part, filename, chunk_start, chunk_end, classifier, dtype, records))
+            if len(pending) < 2 * processes:
+                continue
+
+            yield from chunk_molecules(*pending.popleft().result(), dtype)
+
+        while pending:
+            yield from chunk_molecules(*pending.popleft().result(), dtype)
+
+
+def chunk_molecules(names: List[str], arrays: Dict[str, np.ndarray], atom_types: List[tuple],
+                    mol_records: List[List[str]], dtype: type = np.float_) -> Iterator[Tuple[List[str], Molecule]]:
+    molecules = molecules_from_arrays(names, arrays, atom_types, dtype)
+    if mol_records:
+        return zip(mol_records, molecules)
+    return ((None, molecule) for molecule in molecules)
+
+
 class MoleculeSet:
     def __init__(self, molecules) -> None:
         self._molecules: List[Molecule] = list(molecules)
@@ -22,29 +182,49 @@ class MoleculeSet:
         return 'MoleculeSet: {} molecules'.format(len(self))
 
     @classmethod
-    def load_from_file(cls, filename: str):
-        molecules = []
+    def iterate_file(cls, filename: str, shard: Tuple[int, int] = None, classifier: Classifier = None,
+                     processes: int = 1, dtype: type = np.float_,
+                     records: bool = False) -> Generator[Tuple[List[str], Molecule], None, None]:
+        """Yield molecules one by one as they are loaded (and classified), each with its SDF record if requested"""
         molecule_names = set()
         try:
-            with open(filename) as f:
-                mol_record = []
-                for line in f:
-                    if line.strip() == '$$$$':
-                        molecule = Molecule.create_from_mol(mol_record)
-                        if molecule.name in molecule_names:
-                            raise RuntimeError('Two molecules with the same name! ({})'.format(molecule.name))
-                        else:
-                            molecule_names.add(molecule.name)
-                        molecules.append(molecule)
-                        mol_record = []
-                        continue
-
-                    mol_record.append(line)
+            start, end = shard_range(filename, shard)
+
+            if processes > 1:
+                parts = load_parallel(filename, start, end, classifier, processes, dtype, records)
+            else:
+                parts = ((mol_record, Molecule.create_from_mol(mol_record, dtype))
+                         for mol_record in read_records(filename, start, end))
+
+            for mol_record, molecule in parts:
+                if molecule.name in molecule_names:
+                    raise RuntimeError('Two molecules with the same name! ({})'.format(molecule.name))
+                else:
+                    molecule_names.add(molecule.name)
+
+                if classifier is not None and processes == 1:
+                    classify(molecule, classifier)
+
+                yield mol_record if records else None, molecule
         except IOError:
             print('Cannot open SDF file: {}'.format(filename), file=sys.stderr)
             sys.exit(1)
 
-        return MoleculeSet(molecules)
+    @classmethod
+    def load_from_file(cls, filename: str, shard: Tuple[int, int] = None, classifier: Classifier = None,
+                       processes: int = 1, dtype: type = np.float_):
+        molecules = [molecule for _, molecule in cls.iterate_file(filename, shard, classifier, processes, dtype)]
+        molecule_set = MoleculeSet(molecules)
+        if classifier is not None:
+            molecule_set.index_atom_types()
+
+        return molecule_set
+
+    def subset(self, indices: Iterable[int]) -> 'MoleculeSet':
+        """Set of the molecules at the given indices, sharing them (and their atom types) with this set"""
+        molecule_set = MoleculeSet(self._molecules[i] for i in indices)
+        molecule_set.index_atom_types()
+        return molecule_set
 
     def stats(self):
         atom_types = Counter()
@@ -73,6 +253,33 @@ class MoleculeSet:
                 atom.atom_type = atom.element.symbol, *classifier.get_type(molecule, atom)
                 self._atom_types[atom.atom_type].append((i, j))
 
+    def assign_atom_types_multiple(self, parameters_classifiers: List[ParametersClassifier]) -> List[List[tuple]]:
+        """Classify atoms for several parameter sets in one pass, return types of all atoms for each of them.
+
+        Types for one of the parameter sets are then assigned by set_atom_types."""
+        atom_types = [[] for _ in parameters_classifiers]
+        for molecule in self:
+            for atom in molecule:
+                for types, atom_type in zip(atom_types, classify_multiple(molecule, atom, parameters_classifiers)):
+                    types.append(atom_type)
+
+        return atom_types
+
+    def set_atom_types(self, atom_types: List[tuple]):
+        atom_types = iter(atom_types)
+        for molecule in self:
+            for atom in molecule:
+                atom.atom_type = next(atom_types)
+
+        self.index_atom_types()
+
+    def index_atom_types(self):
+        """Rebuild the index of atom types from the types already assigned to the atoms"""
+        self._atom_types.clear()
+        for i, molecule in enumerate(self):
+            for j, atom in enumerate(molecule):
+                self._atom_types[atom.atom_type].append((i, j))
+
     @property
     def atom_types(self):
         return self._atom_types
@@ -0,0 +1,142 @@
+import abc
+import json
+import os
+import sys
+from typing import Dict, List
+
+import numpy as np
+
+from structures.molecule import Molecule
+
+
+class ChargesWriter(abc.ABC):
+    """Writes charges of each molecule as soon as they are calculated.
+
+    The charges go to a temporary file which replaces the output file only when the writer is closed,
+    so that an interrupted calculation does not leave an output that looks complete."""
+    FORMAT = '<format>'
+
+    # Whether the original SDF record of the molecule is needed
+    NEEDS_RECORDS = False
+
+    def __init__(self, filename: str) -> None:
+        self._filename = filename
+        self._partial_filename = filename + '.part'
+        try:
+            self._file = open(self._partial_filename, 'w')
+        except IOError:
+            self._error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _error(self):
+        print('Cannot store charges to file: {}'.format(self._filename), file=sys.stderr)
+        sys.exit(1)
+
+    def _write(self, data: str):
+        try:
+            self._file.write(data)
+        except IOError:
+            self._error()
+
+    @abc.abstractmethod
+    def write(self, molecule: Molecule, mol_record: List[str], charges: np.ndarray):
+        pass
+
+    def close(self):
+        try:
+            self._file.close()
+            os.replace(self._partial_filename, self._filename)
+        except IOError:
+            self._error()
+
+    def abort(self):
+        """Discard the charges written so far"""
+        self._file.close()
+        try:
+            os.remove(self._partial_filename)
+        except IOError:
+            pass
+
+
+writers: Dict[str, type] = {}
+
+
+def charges_writer(c: type):
+    writers[c.FORMAT] = c
+    return c
+
+
+@charges_writer
+class JsonWriter(ChargesWriter):
+    """Dictionary of charges keyed by molecule names, the same as Charges.save_to_file produces"""
+    FORMAT = 'json'
+
+    def __init__(self, filename: str) -> None:
+        super().__init__(filename)
+        self._separator = ''
+        self._write('{')
+
+    def write(self, molecule: Molecule, mol_record: List[str], charges: np.ndarray):
+        self._write('{}{}: {}'.format(self._separator, json.dumps(molecule.name), json.dumps(charges.tolist())))
+        self._separator = ', '
+
+    def close(self):
+        self._write('}')
+        super().close()
+
+
+@charges_writer
+class SdfWriter(ChargesWriter):
+    """Original SDF records with charges added as a data item"""
+    FORMAT = 'sdf'
+    NEEDS_RECORDS = True
+
+    def write(self, molecule: Molecule, mol_record: List[str], charges: np.ndarray):
+        # The record is kept as it is, including the blank line ending its last data item
+        lines = ['> <charges>']
+        lines.extend('{:.6f}'.format(charge) for charge in charges)
+        lines.append('')
+        lines.append('$$$$\n')
+        self._write(''.join(mol_record) + '\n'.join(lines))
+
+
+# SYBYL types by element and the highest bond order, others are typed by their element only
+SYBYL_TYPES = {('C', 1): 'C.3', ('C', 2): 'C.2', ('C', 3): 'C.1', ('C', 4): 'C.ar',
+               ('N', 1): 'N.3', ('N', 2): 'N.2', ('N', 3): 'N.1', ('N', 4): 'N.ar',
+               ('O', 1): 'O.3', ('O', 2): 'O.2', ('S', 1): 'S.3', ('S', 2): 'S.2', ('P', 1): 'P.3', ('P', 2): 'P.3'}
+
+SYBYL_BOND_TYPES = {1: '1', 2: '2', 3: '3', 4: 'ar'}
+
+
+@charges_writer
+class Mol2Writer(ChargesWriter):
+    """MOL2 records with partial charges"""
+    FORMAT = 'mol2'
+
+    def write(self, molecule: Molecule, mol_record: List[str], charges: np.ndarray):
+        bonds = list(molecule.bonds)
+        lines = ['@<TRIPOS>MOLECULE', molecule.name, '{} {} 0 0 0'.format(len(molecule), len(bonds)),
+                 'SMALL', 'USER_CHARGES', '', '@<TRIPOS>ATOM']
+
+        # Conformers share the atoms, their positions are kept only by the molecule
+        for atom, coordinates, charge in zip(molecule, molecule.coordinates, charges):
+            symbol = atom.element.symbol
+            atom_type = SYBYL_TYPES.get((symbol, molecule.highest_bond_order(atom)), symbol)
+            lines.append('{:>7d} {:<8s} {:>10.4f} {:>10.4f} {:>10.4f} {:<6s} 1 UNL1 {:>10.6f}'.format(
+                atom.index + 1, symbol + str(atom.index + 1), *coordinates, atom_type, charge))
+
+        lines.append('@<TRIPOS>BOND')
+        for i, bond in enumerate(bonds):
+            lines.append('{:>6d} {:>5d} {:>5d} {}'.format(i + 1, bond.atom1.index + 1, bond.atom2.index + 1,
+                                                        SYBYL_BOND_TYPES.get(bond.order, '1')))
+
+        lines.append('')
+        self._write('\n'.join(lines))